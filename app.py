@@ -1,5 +1,14 @@
-import pandas as pd
-import xlwings as xw
+import multiprocessing
+import time
+
+from PySide6.QtCore import QAbstractTableModel
+from PySide6.QtCore import QModelIndex
+from PySide6.QtCore import QObject
+from PySide6.QtCore import QRunnable
+from PySide6.QtCore import QThreadPool
+from PySide6.QtCore import Signal
+from PySide6.QtCore import Slot
+from PySide6.QtGui import QColor
 from PySide6.QtGui import QIntValidator
 from PySide6.QtGui import Qt
 from PySide6.QtWidgets import QApplication
@@ -10,11 +19,16 @@ from PySide6.QtWidgets import QItemDelegate
 from PySide6.QtWidgets import QLineEdit
 from PySide6.QtWidgets import QListWidgetItem
 from PySide6.QtWidgets import QMainWindow
-from PySide6.QtWidgets import QTableWidgetItem
-from qt_material import apply_stylesheet
+from PySide6.QtWidgets import QMessageBox
+from PySide6.QtWidgets import QProgressDialog
 
 from class_record import ClassSheet
-from class_record import randomizer
+from class_record.cache import ParseCache
+from class_record.randomizer import SolutionPool
+from class_record.randomizer import nearest_grades
+from class_record.randomizer import reachable_grades
+from class_record.stats import RunStats
+from class_record.workbook import ClassWorkbook
 from ui.AboutDialog import Ui_AboutDialog
 from ui.EditGradesDialog import Ui_EditGradesDialog
 from ui.InputGradesDialog import Ui_InputGradesDialog
@@ -24,6 +38,12 @@ from version import __version__
 
 RANDOMIZER_MAX_LOOP = 100_000
 RANDOMIZER_THRESHOLD = 1.6
+RANDOMIZER_MODE = 'direct'
+# direct mode solves a learner in milliseconds, a process pool started for every Generate (re-importing the app and
+# PySide6 in each worker on Windows) costs far more than it saves, so the learners are randomized on the worker thread
+RANDOMIZER_WORKERS = 1
+# solutions shared by every sheet opened in the session
+SOLUTION_POOL = SolutionPool()
 
 
 class IntDelegate(QItemDelegate):
@@ -33,6 +53,200 @@ class IntDelegate(QItemDelegate):
         return editor
 
 
+class LearnerTableModel(QAbstractTableModel):
+    # one row per student record, cells are computed on demand so a large roster allocates nothing per cell.
+    # targets are checked against the grades the randomizer can reach with the current options
+    NAME, AVERAGE, TARGET, GENERATED = range(4)
+    HEADERS = ("Learner's Names", 'Current Average', 'New Average', 'Generated')
+
+    def __init__(self, cs: ClassSheet, overwrite_all=True, parent=None):
+        super().__init__(parent)
+        self.cs = cs
+        self.overwrite_all = overwrite_all
+        self.targets = {}
+        self.generated = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.cs.student_records)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return super().headerData(section, orientation, role)
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if index.column() == self.TARGET:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+
+        row, column = index.row(), index.column()
+        sr = self.cs.student_records[row]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if column == self.NAME:
+                return sr.name
+            if column == self.AVERAGE:
+                return '' if sr.transmuted_average is None else str(sr.transmuted_average)
+            if column == self.TARGET:
+                return '' if row not in self.targets else str(self.targets[row])
+            if column == self.GENERATED:
+                return self.generated.get(row, '')
+        elif column == self.AVERAGE and role == Qt.ToolTipRole:
+            return 'Initial grade: {}'.format(sr.initial_average)
+        elif column == self.TARGET and row in self.targets:
+            error = self.target_error(row)
+            if error is not None:
+                if role == Qt.ToolTipRole:
+                    return error
+                if role == Qt.ForegroundRole:
+                    return QColor('red')
+
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or index.column() != self.TARGET:
+            return False
+
+        text = str(value).strip()
+        if not text:
+            self.targets.pop(index.row(), None)
+        else:
+            try:
+                self.targets[index.row()] = int(text)
+            except ValueError:
+                return False
+        self.dataChanged.emit(index, index)
+        return True
+
+    def target_error(self, row: int):
+        # why the target of the row cannot be generated, None when it can
+        sr = self.cs.student_records[row]
+        expected_average = self.targets[row]
+        if expected_average == sr.transmuted_average:
+            return None
+
+        grades = reachable_grades(sr, self.cs.head_components, RANDOMIZER_THRESHOLD, self.overwrite_all)
+        if expected_average in grades:
+            return None
+        nearest = nearest_grades(expected_average, grades)
+        return 'Not reachable, nearest: {}'.format(', '.join(str(grade) for grade in nearest) or 'none')
+
+    def invalid_targets(self) -> dict:
+        return {row: error for row, error in ((row, self.target_error(row)) for row in sorted(self.targets))
+                if error is not None}
+
+    def set_overwrite_all(self, overwrite_all: bool):
+        self.overwrite_all = overwrite_all
+        if self.targets:
+            self.dataChanged.emit(self.index(0, self.TARGET), self.index(self.rowCount() - 1, self.TARGET))
+
+    def set_generated(self, row: int, text: str):
+        self.generated[row] = text
+        index = self.index(row, self.GENERATED)
+        self.dataChanged.emit(index, index)
+
+    def clear_generated(self):
+        self.generated.clear()
+        self.dataChanged.emit(self.index(0, self.GENERATED), self.index(self.rowCount() - 1, self.GENERATED))
+
+
+def warn_failures(parent, cs: ClassSheet, failures: dict):
+    if not failures:
+        return
+
+    names = '\n'.join('{}: {}'.format(cs.student_records[idx].name, error) for idx, error in sorted(failures.items()))
+    QMessageBox.warning(parent, 'Class Genie', 'Scores were not generated for:\n{}'.format(names))
+
+
+class WorkerSignals(QObject):
+    progress = Signal(int, object, object)
+    finished = Signal(object)
+    cancelled = Signal()
+    error = Signal(str)
+
+
+class Worker(QRunnable):
+    # runs fn(worker) on a pool thread, fn reports through worker.signals and polls worker.is_cancelled
+    def __init__(self, fn):
+        super().__init__()
+        self.fn = fn
+        self.signals = WorkerSignals()
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    @Slot()
+    def run(self):
+        try:
+            result = self.fn(self)
+        except Exception as e:
+            # parallel.Cancelled, or anything else raised after Cancel was pressed
+            if self._cancelled:
+                self.signals.cancelled.emit()
+            else:
+                self.signals.error.emit(str(e))
+        else:
+            if self._cancelled:
+                self.signals.cancelled.emit()
+            else:
+                self.signals.finished.emit(result)
+
+
+def show_stats(widget, stats: RunStats):
+    # on the status bar of the main window, and in the stats log when one is set
+    stats.log()
+    while widget is not None and not isinstance(widget, QMainWindow):
+        widget = widget.parent()
+    if widget is not None:
+        widget.statusBar().showMessage('{}: {}'.format(stats.operation, stats.summary()))
+
+
+def run_in_background(parent, label, maximum, fn, on_finished, on_progress=None, on_stopped=None):
+    # fn(worker) runs on the global thread pool behind a modal progress dialog with a Cancel button
+    progress = QProgressDialog(label, 'Cancel', 0, maximum, parent)
+    progress.setWindowModality(Qt.WindowModal)
+    progress.setMinimumDuration(0)
+    progress.setAutoClose(False)
+    progress.setAutoReset(False)
+
+    worker = Worker(fn)
+    progress.canceled.connect(worker.cancel)
+    worker.signals.progress.connect(lambda *args: progress.setValue(progress.value() + 1))
+    if on_progress is not None:
+        worker.signals.progress.connect(on_progress)
+
+    def finished(result):
+        progress.close()
+        on_finished(result)
+
+    def stopped(message=None):
+        progress.close()
+        if message is not None:
+            QMessageBox.critical(parent, 'Class Genie', message)
+        if on_stopped is not None:
+            on_stopped()
+
+    worker.signals.finished.connect(finished)
+    worker.signals.cancelled.connect(stopped)
+    worker.signals.error.connect(stopped)
+
+    progress.setValue(0)
+    QThreadPool.globalInstance().start(worker)
+
+    return worker, progress
+
+
 class AboutDialog(QDialog):
     def __init__(self, parent):
         super().__init__(parent)
@@ -44,82 +258,108 @@ class AboutDialog(QDialog):
         self.ui.versionLabel.setText(__version__)
 
 
-class EditGradesDialog(QDialog):
-    def __init__(self, parent, cs):
+class GenerateDialog(QDialog):
+    # what both grade dialogs share: the scores are randomized on a worker thread inside a journal transaction, so a
+    # generation can be undone from the main window; a stopped run is rolled back, a finished one committed and saved
+    def __init__(self, parent, cs: ClassSheet):
         super().__init__(parent)
+        self.ui = None
+        self.cs = cs
+        self.worker = None
+        self.progress = None
+        self.stats = None
+
+    def generate_scores(self, targets: dict, overwrite_all: bool):
+        def job(worker):
+            # numpy is only loaded once scores are generated
+            from class_record import parallel
+
+            return parallel.randomize_class(self.cs, targets, workers=RANDOMIZER_WORKERS,
+                                            max_loop=RANDOMIZER_MAX_LOOP,
+                                            threshold=RANDOMIZER_THRESHOLD,
+                                            overwrite_all=overwrite_all,
+                                            mode=RANDOMIZER_MODE,
+                                            progress=worker.signals.progress.emit,
+                                            cancelled=worker.is_cancelled,
+                                            stats=self.stats,
+                                            pool=SOLUTION_POOL)
+
+        self.cs.take_stats()
+        self.stats = RunStats('generate')
+        self.ui.pushButton.setEnabled(False)
+        self.cs.journal.begin('generate')
+        self.worker, self.progress = run_in_background(self, 'Generating scores...', len(targets), job,
+                                                       on_finished=self.save,
+                                                       on_progress=self.show_learner,
+                                                       on_stopped=self.stopped)
+
+    def show_learner(self, idx, average, error):
+        self.progress.setLabelText('{}: {}'.format(self.cs.student_records[idx].name, error or average))
+
+    def stopped(self):
+        self.cs.journal.rollback()
+        self.ui.pushButton.setEnabled(True)
+
+    def save(self, failures):
+        # save scores to excel, Excel is only driven from the main thread
+        self.cs.journal.commit()
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        self.cs.save_sheet()
+        QApplication.restoreOverrideCursor()
+        show_stats(self, self.stats.merge(self.cs.take_stats()))
+        warn_failures(self, self.cs, failures)
+        self.close()
+
+
+class EditGradesDialog(GenerateDialog):
+    def __init__(self, parent, cs):
+        super().__init__(parent, cs)
         self.ui = Ui_EditGradesDialog()
         self.ui.setupUi(self)
 
-        self.cs = cs
-
         self.ui.pushButton.clicked.connect(self.generate)
 
     def generate(self):
         offset_value = self.ui.spinBox.value()
-        for sr in self.cs.student_records:
-            expected_average = sr.transmuted_average + offset_value
-            overwrite_all = self.ui.checkBox.isChecked()
-            randomizer.randomize_student_record(sr, expected_average, self.cs.head_components,
-                                                max_loop=RANDOMIZER_MAX_LOOP,
-                                                threshold=RANDOMIZER_THRESHOLD,
-                                                overwrite_all=overwrite_all)
-
-        # save scores to excel
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        self.cs.save_sheet()
-        QApplication.restoreOverrideCursor()
-        self.close()
+        targets = {idx: sr.transmuted_average + offset_value for idx, sr in enumerate(self.cs.student_records)}
+        self.generate_scores(targets, self.ui.checkBox.isChecked())
 
 
-class InputGradesDialog(QDialog):
+class InputGradesDialog(GenerateDialog):
     def __init__(self, parent, cs: ClassSheet):
-        super().__init__(parent)
+        super().__init__(parent, cs)
         self.ui = Ui_InputGradesDialog()
         self.ui.setupUi(self)
 
-        self.cs = cs
-
-        df = pd.DataFrame([[student.name, ''] for student in self.cs.student_records])
-        self.df = df
-        self.ui.tableWidget.setRowCount(df.shape[0])
-        self.ui.tableWidget.setColumnCount(df.shape[1])
-
+        self.model = LearnerTableModel(cs, parent=self)
+        self.ui.tableView.setModel(self.model)
+        self.ui.checkBox.toggled.connect(self.model.set_overwrite_all)
         self.ui.checkBox.setChecked(True)
-        self.ui.tableWidget.setHorizontalHeaderLabels(["Learner's Names", "New Average"])
-
-        self.ui.tableWidget.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
-        self.ui.tableWidget.horizontalHeader().setStretchLastSection(True)
 
-        self.ui.tableWidget.setItemDelegateForColumn(1, IntDelegate())
+        self.ui.tableView.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        self.ui.tableView.horizontalHeader().setStretchLastSection(True)
+        self.ui.tableView.resizeColumnToContents(LearnerTableModel.AVERAGE)
+        self.ui.tableView.setColumnWidth(LearnerTableModel.NAME, 240)
 
-        for row in range(self.ui.tableWidget.rowCount()):
-            for col in range(self.ui.tableWidget.columnCount()):
-                item = QTableWidgetItem(str(self.df.iloc[row, col]))
+        self.target_delegate = IntDelegate()
+        self.ui.tableView.setItemDelegateForColumn(LearnerTableModel.TARGET, self.target_delegate)
 
-                self.ui.tableWidget.setItem(row, col, item)
-
-        self.ui.tableWidget.cellChanged[int, int].connect(self.update_df)
         self.ui.pushButton.clicked.connect(self.generate)
 
-    def update_df(self, row, column):
-        text = self.ui.tableWidget.item(row, column).text()
-        self.df.iloc[row, column] = text
-
     def generate(self):
-        for row in self.df.iterrows():
-            row_idx, values = row
-            if values[1] is not None and values[1] != '':
-                value = str(self.df.iloc[row_idx, 1])
-                overwrite_all = bool(self.ui.checkBox.checkState())
-                randomizer.randomize_student_record(self.cs.student_records[row_idx], int(value),
-                                                    self.cs.head_components, max_loop=RANDOMIZER_MAX_LOOP,
-                                                    overwrite_all=overwrite_all, threshold=RANDOMIZER_THRESHOLD)
-
-        # save scores to excel
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        self.cs.save_sheet()
-        QApplication.restoreOverrideCursor()
-        self.close()
+        invalid = self.model.invalid_targets()
+        if invalid:
+            names = '\n'.join('{}: {}'.format(self.cs.student_records[row].name, error)
+                              for row, error in invalid.items())
+            QMessageBox.warning(self, 'Class Genie', 'These targets cannot be generated:\n{}'.format(names))
+            return
+
+        self.model.clear_generated()
+        self.generate_scores(dict(self.model.targets), self.ui.checkBox.isChecked())
+
+    def show_learner(self, idx, average, error):
+        self.model.set_generated(idx, str(error or average))
+        self.ui.tableView.scrollTo(self.model.index(idx, LearnerTableModel.GENERATED))
 
 
 class OptionDialog(QDialog):
@@ -132,17 +372,37 @@ class OptionDialog(QDialog):
         self.cs = cs
         self.input_grades = None
         self.edit_grades = None
+        self.worker = None
+        self.progress = None
 
         self.ui.buttonNewAverage.clicked.connect(self.create_new_average)
         self.ui.buttonExistingAverage.clicked.connect(self.edit_existing_average)
 
-    def create_new_average(self):
+    def load_learners(self, on_loaded):
+        if self.cs.parsed:
+            on_loaded()
+            return
+
+        # the sheet is read here since Excel is only driven from the main thread, parsing it runs in the background
         QApplication.setOverrideCursor(Qt.WaitCursor)
-        self.input_grades = InputGradesDialog(self, self.cs)
+        self.cs.label_components
         QApplication.restoreOverrideCursor()
+
+        self.worker, self.progress = run_in_background(self, 'Reading learners...', 0,
+                                                       lambda worker: self.cs.student_records,
+                                                       on_finished=lambda records: on_loaded())
+
+    def create_new_average(self):
+        self.load_learners(self.show_input_grades)
+
+    def show_input_grades(self):
+        self.input_grades = InputGradesDialog(self, self.cs)
         self.input_grades.show()
 
     def edit_existing_average(self):
+        self.load_learners(self.show_edit_grades)
+
+    def show_edit_grades(self):
         self.edit_grades = EditGradesDialog(self, self.cs)
         self.edit_grades.show()
 
@@ -157,7 +417,6 @@ class MainWindow(QMainWindow):
         self.ui.listWidget.hide()
         self.ui.pushButton.hide()
 
-        self.app = xw.App(visible=False, add_book=False)
         self.wb = None
         self.cs = None
         self.dialog = None
@@ -165,48 +424,80 @@ class MainWindow(QMainWindow):
 
         self.ui.actionOpen.triggered.connect(self.open_workbook)
         self.ui.actionAbout.triggered.connect(lambda: self.about.show())
+        self.ui.actionUndo.triggered.connect(self.undo)
+        self.ui.actionRedo.triggered.connect(self.redo)
         self.ui.pushButton.clicked.connect(self.edit_selected)
 
     def open_workbook(self):
         url = QFileDialog.getOpenFileName(self, filter='Excel Files (*.xlsx)')
         if url[0]:
-            if self.app.books:
-                print('has active')
-                self.app.books.active.close()
+            if self.wb is not None:
+                self.wb.close()
                 self.ui.listWidget.clear()
 
-            QApplication.setOverrideCursor(Qt.WaitCursor)
-            self.wb: xw.Book = self.app.books.open(url[0], update_links=False)
-            QApplication.restoreOverrideCursor()
+            # only the sheet names are read here, Excel opens the book once a sheet is edited and unchanged sheets
+            # are loaded from the parse cache
+            self.wb = ClassWorkbook(url[0], excel=True, cache=ParseCache())
 
             self.ui.listWidget.show()
             self.ui.pushButton.show()
-            for sheet in self.wb.sheets:
-                item = QListWidgetItem(sheet.name)
-                item.setData(1, sheet)
-                self.ui.listWidget.addItem(sheet.name)
+            for name in self.wb.sheet_names:
+                self.ui.listWidget.addItem(name)
 
     def edit_selected(self):
         index: QListWidgetItem = self.ui.listWidget.currentItem()
         if index is None:
             return
 
-        sheet = self.wb.sheets[index.text()]
-        self.cs = ClassSheet(sheet)
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        self.cs = self.wb.class_sheet(index.text())
+        QApplication.restoreOverrideCursor()
+        show_stats(self, self.cs.take_stats('open:{}'.format(index.text())))
+
         self.dialog = OptionDialog(self, index.text(), self.cs)
         self.dialog.show()
 
-    def closeEvent(self, event):
-        self.wb.close()
-        self.app.quit()
+    def _replay(self, undo: bool):
+        # the journal puts back only the scores of the generation, save_sheet writes those cells and nothing is read
+        # from Excel again
+        if self.cs is None or self.cs.journal.active:
+            return
+        transaction = self.cs.journal.undo() if undo else self.cs.journal.redo()
+        if transaction is None:
+            self.statusBar().showMessage('Nothing to {}'.format('undo' if undo else 'redo'))
+            return
 
+        QApplication.setOverrideCursor(Qt.WaitCursor)
+        report = self.cs.save_sheet()
+        QApplication.restoreOverrideCursor()
+        self.cs.take_stats()
+        self.statusBar().showMessage('{} {}: {} components, {} cells'.format(
+            'Undid' if undo else 'Redid', transaction.label, len(transaction), report.cells))
 
-if __name__ == '__main__':
-    app = QApplication([])
-    main_window = MainWindow()
+    def undo(self):
+        self._replay(True)
 
-    main_window.show()
+    def redo(self):
+        self._replay(False)
 
-    apply_stylesheet(app, 'dark_red.xml')
+    def closeEvent(self, event):
+        if self.wb is not None:
+            self.wb.close()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    # the CPU time of the process so far went to the imports, the window is timed until it is shown and styled
+    startup = RunStats('startup')
+    startup.phases['imports'] = time.process_time()
+    with startup.phase('window'):
+        app = QApplication([])
+        main_window = MainWindow()
+
+        main_window.show()
+
+        from qt_material import apply_stylesheet
+        apply_stylesheet(app, 'dark_red.xml')
+    show_stats(main_window, startup)
 
     app.exec()
@@ -1,48 +1,170 @@
 import os.path
+from array import array
 from collections import namedtuple
+from typing import TYPE_CHECKING
+from typing import Union
 
-import xlwings as xw
+from class_record.backends import SheetBackend
+from class_record.backends import XlwingsBackend
+from class_record.stats import RunStats
+from class_record.transmutation import RangeTuple
+from class_record.transmutation import TransmutationTable
+
+if TYPE_CHECKING:
+    import xlwings as xw
+
+    from class_record.journal import EditJournal
 
 TRANSMUTATION_TABLE_PATH = 'resources/transmutation_table.txt'
 
-RangeTuple = namedtuple('RangeTuple', ['min', 'max', 'transmuted'])
-
-with open(os.path.join(os.path.dirname(__file__), TRANSMUTATION_TABLE_PATH), 'r') as f:
-    _data = f.read().strip()
-    _rows = [row.strip().split(',') for row in _data.splitlines()]
-    TRANSMUTATION_TABLE = []
-    for row in _rows:
-        _range = tuple(map(float, row[0].split('-')))
-        _transmuted = int(row[1].strip())
-        TRANSMUTATION_TABLE.append(
-            RangeTuple(min=_range[0], max=_range[1], transmuted=_transmuted)
-        )
+ComponentColumns = namedtuple('ComponentColumns', ['label', 'start', 'end'])
+SaveReport = namedtuple('SaveReport', ['cells', 'calls'])
+
+# compiled on the first lookup, importing the package reads nothing
+TRANSMUTATION_TABLE = TransmutationTable.from_file(os.path.join(os.path.dirname(__file__), TRANSMUTATION_TABLE_PATH),
+                                                  lazy=True)
 
 
 def transmute_grade(initial_grade):
-    for row in TRANSMUTATION_TABLE:
-        if row.min <= initial_grade <= row.max:
-            return row.transmuted
+    return TRANSMUTATION_TABLE.transmute(initial_grade)
+
+
+def transmute_many(initial_grades, default=0):
+    return TRANSMUTATION_TABLE.transmute_many(initial_grades, default)
+
+
+def _pack(scores: list) -> tuple:
+    # (values, blank mask): whole numbers in an array('q'), other numbers in an array('d'), with blanks stored as 0
+    # and bit i of the mask set when score i is blank. anything else (text in a score cell) stays a plain list
+    mask = 0
+    filled = scores
+    if None in scores:
+        filled = list(scores)
+        for idx, score in enumerate(filled):
+            if score is None:
+                mask |= 1 << idx
+                filled[idx] = 0
+
+    # sheets give floats and the randomizer ints, the first score tells which array to try first
+    typecodes = ('d', 'q') if filled and type(filled[0]) is float else ('q', 'd')
+    for typecode in typecodes:
+        try:
+            return array(typecode, filled), mask
+        except (TypeError, OverflowError):
+            pass
+
+    return list(scores), 0
+
+
+def _unpack(values, mask: int) -> list:
+    scores = values.tolist() if isinstance(values, array) else list(values)
+    while mask:
+        lowest = mask & -mask
+        scores[lowest.bit_length() - 1] = None
+        mask ^= lowest
+
+    return scores
 
 
 class Component:
+    # the scores are kept packed (see _pack), the scores property unpacks a new list on every read
+    __slots__ = ('_values', '_mask', '_saved', '_highest_total_score', '_weight', 'label', '_version', '_total',
+                 '_weighted_average', '_owner')
+
     def __init__(self, scores: list, weight: float, highest_total_score: int = None, label=None):
+        self._version = 0
+        # the ClassSheet holding the learner's component, its open journal transaction is told of score changes
+        self._owner = None
         self.scores = scores
-        self.highest_total_score = highest_total_score if highest_total_score is not None else (self._sum_scores())
-        self.weight = weight
+        self._saved = (self._values, self._mask)
+        self._highest_total_score = highest_total_score if highest_total_score is not None else self._sum_scores()
+        self._weight = weight
         self.label = label
 
         if self._sum_scores() > self.highest_total_score:
             raise ValueError("Sum of scores exceeded the highest_total_score.")
 
-    def _percentage_score(self):
+    @property
+    def scores(self) -> list:
+        return _unpack(self._values, self._mask)
+
+    @scores.setter
+    def scores(self, scores: list):
+        # a copy is kept, changing the list afterwards does not change the component, assign a new list instead
+        if self._owner is not None:
+            self._log_edit()
+        self._values, self._mask = _pack(scores)
+        self._changed()
+
+    @property
+    def highest_total_score(self):
+        return self._highest_total_score
+
+    @highest_total_score.setter
+    def highest_total_score(self, highest_total_score):
+        self._highest_total_score = highest_total_score
+        self._changed()
+
+    @property
+    def weight(self) -> float:
+        return self._weight
+
+    @weight.setter
+    def weight(self, weight: float):
+        self._weight = weight
+        self._changed()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def _changed(self):
+        self._total = None
+        self._weighted_average = None
+        self._version += 1
+
+    def percentage_score(self):
         return round((self._sum_scores() / self.highest_total_score) * 100, 2)
 
     def weighted_average(self):
-        return round(self._percentage_score() * self.weight, 2)
+        if self._weighted_average is None:
+            self._weighted_average = round(self.percentage_score() * self.weight, 2)
+
+        return self._weighted_average
 
     def _sum_scores(self):
-        return sum([score for score in self.scores if score is not None])
+        if self._total is None:
+            if isinstance(self._values, array):
+                # blanks are stored as 0
+                self._total = sum(self._values)
+            else:
+                self._total = sum([score for score in self._values if score is not None])
+
+        return self._total
+
+    def snapshot(self) -> tuple:
+        # the packed scores, a token for restore; nothing is copied since assigning scores packs new values
+        return self._values, self._mask
+
+    def restore(self, snapshot: tuple):
+        if snapshot[0] is not self._values or snapshot[1] != self._mask:
+            if self._owner is not None:
+                self._log_edit()
+            self._values, self._mask = snapshot
+            self._changed()
+
+    def _log_edit(self):
+        # keeps the scores from before the first change made while the owner's journal has a transaction open
+        edits = self._owner._edits
+        if edits is not None and self not in edits:
+            edits[self] = (self, self.snapshot())
+
+    @property
+    def modified(self) -> bool:
+        return (self._values, self._mask) != self._saved
+
+    def mark_saved(self):
+        self._saved = (self._values, self._mask)
 
     def __repr__(self):
         return "<Component(label='{}', scores='{}', highest_total_score='{}', weight='{}')>".format(
@@ -51,11 +173,16 @@ class Component:
 
 
 class StudentRecord:
+    __slots__ = ('name', 'components', '_averages_key', '_initial_average', '_transmuted_average')
+
     def __init__(self, *, name=None, components: list):
         if components is None:
             components = []
         self.name = name
         self.components = components
+        self._averages_key = None
+        self._initial_average = None
+        self._transmuted_average = None
 
         if not self.is_valid_weight() and components != []:
             raise ValueError("Total weight is not 1 or 100%")
@@ -64,15 +191,24 @@ class StudentRecord:
         weights = [component.weight for component in self.components]
         return sum(weights) == 1
 
+    def _averages(self):
+        # recomputed only when a component was replaced or one of them changed since the last call
+        key = tuple((component, component.version) for component in self.components)
+        if key != self._averages_key:
+            weighted_averages = [component.weighted_average() for component in self.components]
+            self._initial_average = sum(weighted_averages)
+            self._transmuted_average = transmute_grade(self._initial_average)
+            self._averages_key = key
+
     @property
     def initial_average(self):
-        weighted_averages = [component.weighted_average() for component in self.components]
-
-        return sum(weighted_averages)
+        self._averages()
+        return self._initial_average
 
     @property
     def transmuted_average(self):
-        return transmute_grade(self.initial_average)
+        self._averages()
+        return self._transmuted_average
 
     def __repr__(self):
         return "<StudentRecord(name='{}', components='{}', transmuted_average='{}')>".format(self.name, self.components,
@@ -81,97 +217,128 @@ class StudentRecord:
 
 class ClassSheet:
 
-    def __init__(self, sheet: xw.Sheet):
-        self._sheet: xw.Sheet = sheet
-
-        self._max_row = None
-        self._max_column = None
-        self._used_range = None
-        self._label = None
+    def __init__(self, sheet: Union[SheetBackend, 'xw.Sheet'], on_save=None, on_parse=None):
+        if not isinstance(sheet, SheetBackend):
+            sheet = XlwingsBackend(sheet)
+        self._backend: SheetBackend = sheet
+        # called with the sheet once save_sheet has saved the workbook
+        self._on_save = on_save
+        # called with the sheet once its learners have been parsed, on the thread that asked for them
+        self._on_parse = on_parse
+        # backend calls and parse/write/save times, see take_stats
+        self.stats = RunStats('sheet')
+
+        self._grid = None
+        self._label_row = None
         self._label_components = None
         self._head_components = None
-        self._students = None
+        self._student_rows = None
         self._student_records = None
-
-        self._student_males_idx = None
-        self._student_females_idx = None
+        self._journal = None
+        # {component: (component, snapshot)} of the open journal transaction, see class_record.journal
+        self._edits = None
+
+    @classmethod
+    def from_parsed(cls, sheet: SheetBackend, label_row: int, label_components: list[ComponentColumns],
+                    head_components: list[Component], student_rows: list[int], student_records: list[StudentRecord],
+                    on_save=None) -> 'ClassSheet':
+        # a sheet parsed earlier (see class_record.cache), the grid is only read again if something asks for it
+        cs = cls(sheet, on_save=on_save)
+        cs._label_row = label_row
+        cs._label_components = label_components
+        cs._head_components = head_components
+        cs._student_rows = student_rows
+        cs._student_records = student_records
+        cs._own(student_records)
+
+        return cs
 
     @property
-    def sheet(self) -> xw.Sheet:
-        return self._sheet
+    def backend(self) -> SheetBackend:
+        return self._backend
 
-    @property
-    def max_row(self) -> int:
-        if self._max_row is None:
-            self._max_row = self._sheet.used_range.last_cell.row
+    def take_stats(self, operation: str = None) -> RunStats:
+        # the stats gathered since the last call, the sheet starts counting anew
+        stats, self.stats = self.stats, RunStats('sheet')
+        if operation is not None:
+            stats.operation = operation
 
-        return self._max_row
+        return stats
+
+    def _own(self, student_records: list[StudentRecord]):
+        for record in student_records:
+            for component in record.components:
+                component._owner = self
 
     @property
-    def max_column(self) -> int:
-        if self._max_column is None:
-            self._max_column = self._sheet.range('A1').merge_area.last_cell.column
+    def journal(self) -> 'EditJournal':
+        # undo and redo of the edits made to the learners' scores, see class_record.journal
+        if self._journal is None:
+            from class_record.journal import EditJournal
+            self._journal = EditJournal(self)
 
-        return self._max_column
+        return self._journal
 
     @property
-    def used_range(self) -> xw.Range:
-        if self._used_range is None:
-            self._used_range = self._sheet.range('A1', (self.max_row, self.max_column))
+    def parsed(self) -> bool:
+        return self._student_records is not None
 
-        return self._used_range
+    @property
+    def grid(self) -> list[list]:
+        # the whole used range in a single read, everything below is parsed from this snapshot
+        if self._grid is None:
+            with self.stats.phase('read'):
+                self._grid = self._backend.read_grid()
+            self.stats.read(sum(len(row) for row in self._grid))
+
+        return self._grid
 
     @property
-    def label(self) -> xw.Range:
-        if self._label is None:
-            rows = self.used_range.rows
-            for idx, rng in enumerate(rows):
-                if str(rng.value[0]).endswith('QUARTER'):
-                    self._label = rows[idx + 1]
+    def label_row(self) -> int:
+        if self._label_row is None:
+            for idx, row in enumerate(self.grid):
+                if str(row[0]).endswith('QUARTER'):
+                    self._label_row = idx + 1
                     break
 
-        return self._label
+        return self._label_row
 
     @property
-    def head_components(self) -> list[Component]:
-        if self._head_components is None:
-            rng: xw.Range = self.label.offset(2, 0)  # 2 rows below the label is the component data
-            component_ranges = self.get_component_ranges(rng)
+    def label(self) -> list:
+        return self.grid[self.label_row]
 
-            self._head_components = [self.generate_component(rng, label.value) for rng, label in
-                                     zip(component_ranges, self.label_components)]
+    def label_merge_areas(self) -> dict[int, int]:
+        # only the labelled cells of a single row need their merge area
+        columns = [col for col, value in enumerate(self.label, start=1) if value is not None]
+        with self.stats.phase('read'):
+            merges = self._backend.merge_areas(self.label_row + 1, columns)
+        self.stats.read(len(columns))
 
-        return self._head_components
+        return merges
 
     @property
-    def label_components(self) -> list[xw.Range]:
+    def label_components(self) -> list[ComponentColumns]:
         if self._label_components is None:
-            labels = []
-            for label in self.label.columns:
-                if label.value is not None and label.merge_cells and label.value != "LEARNERS' NAMES":
-                    labels.append(
-                        label
-                    )
-            self._label_components = labels
+            self._label_components = find_label_components(self.label, self.label_merge_areas())
 
         return self._label_components
 
-    def get_component_ranges(self, rng: xw.Range) -> list[xw.Range]:
-        # slicing the columns, and convert it into components
-        ranges = []
-        for label in self.label_components:
-            col = label.column
-            end_col = label.merge_area.last_cell.column
+    @property
+    def head_components(self) -> list[Component]:
+        if self._head_components is None:
+            row = self.grid[self.label_row + 2]  # 2 rows below the label is the component data
+            self._head_components = [self.generate_component(data, label.label) for data, label in
+                                     zip(self.get_component_data(row), self.label_components)]
 
-            ranges.append(
-                rng.columns[col - 1:end_col].rng
-            )
-        return ranges
+        return self._head_components
+
+    def get_component_data(self, row: list) -> list[list]:
+        # slicing the columns, and convert it into components
+        return [row[label.start:label.end] for label in self.label_components]
 
     @staticmethod
-    def generate_component(rng: xw.Range, label=None, highest_total_score=None, weight=None, fixed_scores_length=None):
+    def generate_component(data: list, label=None, highest_total_score=None, weight=None, fixed_scores_length=None):
 
-        data = rng.value
         if fixed_scores_length is None:
             scores = [i for i in data[:len(data) - 3] if i is not None]
         else:
@@ -188,76 +355,130 @@ class ClassSheet:
             weight=weight
         )
 
-    @property
-    def students(self):
+    def _expand_down(self, idx: int) -> range:
+        # same rows as xw.Range.expand('down'), following the first column
+        last = idx
+        while last + 1 < len(self.grid) and self.grid[last + 1][0] is not None:
+            last += 1
 
-        if self._students is None:
+        return range(idx, last + 1)
 
-            male_std = None
-            female_std = None
+    @property
+    def student_rows(self) -> list[int]:
+        if self._student_rows is None:
+            rows = []
             last_idx = 0
-            # male
-            for idx, row in enumerate(self.used_range.rows):
-                if str(row.value[1]).startswith('MALE'):
-                    male_std = self.used_range.rows[idx + 1].expand('down')
-                    last_idx = male_std.last_cell.row - 1
-                    break
-            # female
-            for idx, row in enumerate(self.used_range.rows[last_idx:], start=last_idx):
-                if str(row.value[1]).startswith('FEMALE'):
-                    female_std = self.used_range.rows[idx + 1].expand('down')
-                    break
+            for marker in ('MALE', 'FEMALE'):
+                for idx in range(last_idx, len(self.grid)):
+                    if str(self.grid[idx][1]).startswith(marker) and idx + 1 < len(self.grid):
+                        block = self._expand_down(idx + 1)
+                        rows.extend(block)
+                        last_idx = block[-1]
+                        break
 
-            students = [std for std in male_std.rows]
-            students.extend([std for std in female_std.rows])
-            self._students = students
+            self._student_rows = rows
 
-        return self._students
+        return self._student_rows
+
+    @property
+    def students(self) -> list[list]:
+        return [self.grid[idx] for idx in self.student_rows]
 
     @property
     def student_records(self):
         if self._student_records is None:
-            student_records = []
-            for rng in self.students:
-                component_ranges = self.get_component_ranges(rng)
-                components = [
-                    self.generate_component(rng=rng,
-                                            weight=head.weight,
-                                            highest_total_score=head.highest_total_score,
-                                            fixed_scores_length=len(head.scores)
-                                            ) for head, rng in zip(self.head_components, component_ranges)
-                ]
-                student_records.append(
-                    StudentRecord(name=rng.value[1], components=components)
-                )
-
-            self._student_records = student_records
+            students = self.students
+            with self.stats.phase('parse'):
+                self._student_records = [make_student_record(row, self.label_components, self.head_components)
+                                         for row in students]
+            self._own(self._student_records)
+            if self._on_parse is not None:
+                self._on_parse(self)
 
         return self._student_records
 
-    def save_sheet(self):
-        for rng, record in zip(self.students, self.student_records):
-            comp_ranges = self.get_component_ranges(rng)
-            student_components = record.components
-            for comp_rng, comp in zip(comp_ranges, student_components):
-                comp_rng.value = comp.scores
-
-        self.sheet.book.save()
-
+    def modified_blocks(self) -> list[tuple[int, int, list[list]]]:
+        # one rectangular block per component and per run of adjacent learners with modified scores
+        blocks = []
+        for comp_idx, label in enumerate(self.label_components):
+            block = None
+            for row_idx, record in zip(self.student_rows, self.student_records):
+                comp = record.components[comp_idx]
+                if not comp.modified:
+                    block = None
+                    continue
+
+                if block is not None and block[0] + len(block[2]) == row_idx and len(block[2][0]) == len(comp.scores):
+                    block[2].append(list(comp.scores))
+                else:
+                    block = (row_idx, label.start, [list(comp.scores)])
+                    blocks.append(block)
+
+        return blocks
+
+    def write_sheet(self) -> SaveReport:
+        # writes the modified scores without saving, so several sheets can share one workbook save
+        blocks = self.modified_blocks()
+        cells = 0
+        with self.stats.phase('write'):
+            for row_idx, col_idx, values in blocks:
+                self._backend.write_block(row_idx + 1, col_idx + 1, values)
+                block_cells = 0
+                for offset, scores in enumerate(values):
+                    if self._grid is not None:
+                        self._grid[row_idx + offset][col_idx:col_idx + len(scores)] = scores
+                    block_cells += len(scores)
+                self.stats.write(block_cells)
+                cells += block_cells
+
+        for record in self.student_records:
+            for comp in record.components:
+                comp.mark_saved()
+
+        return SaveReport(cells=cells, calls=len(blocks))
+
+    def save_sheet(self) -> SaveReport:
+        report = self.write_sheet()
+        if report.calls:
+            with self.stats.phase('save'):
+                self._backend.save()
+            self.stats.saves += 1
+            if self._on_save is not None:
+                self._on_save(self)
+
+        return report
+
+
+def make_student_record(row: list, label_components: list[ComponentColumns],
+                        head_components: list[Component]) -> StudentRecord:
+    components = [
+        ClassSheet.generate_component(data=row[label.start:label.end],
+                                      label=label.label,
+                                      weight=head.weight,
+                                      highest_total_score=head.highest_total_score,
+                                      fixed_scores_length=len(head.scores)
+                                      ) for head, label in zip(head_components, label_components)
+    ]
+
+    return StudentRecord(name=row[1], components=components)
+
+
+def find_label_components(label: list, merges: dict[int, int]) -> list[ComponentColumns]:
+    labels = []
+    for col, value in enumerate(label, start=1):
+        if value is not None and col in merges and value != "LEARNERS' NAMES":
+            labels.append(
+                ComponentColumns(label=value, start=col - 1, end=merges[col])
+            )
 
-class ClassRecord:
-    def __init__(self, males: list, females: list) -> None:
-        self.males = males
-        self.females = females
+    return labels
 
 
-if __name__ == '__main__':
-    app = xw.App(visible=False, add_book=False)
-    wb = app.books.open('D:/PycharmProjects/ClassGenie/GRADE-3-4TH-QUARTER-new.xlsx', update_links=False,
-                        read_only=True)
+def __getattr__(name):
+    # the columnar engine needs numpy, it is only imported once ClassRecord is used
+    if name == 'ClassRecord':
+        from class_record.engine import ClassRecord
+        return ClassRecord
 
-    ws = wb.sheets['MTB']
-    print(ws)
-    cs = ClassSheet(ws)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
 
-    app.kill()
@@ -0,0 +1,144 @@
+from typing import Iterator
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import xlwings as xw
+
+
+class SheetBackend:
+    # rows and columns are 1-based like in Excel, the grid returned by read_grid is 0-based
+
+    @property
+    def name(self) -> str:
+        raise NotImplementedError
+
+    def read_grid(self) -> list[list]:
+        raise NotImplementedError
+
+    def iter_rows(self) -> Iterator[list]:
+        # one list per row starting at row 1, backends that can stream override this
+        yield from self.read_grid()
+
+    def merge_areas(self, row: int, columns: list[int]) -> dict[int, int]:
+        # {first column: last column} of the merged cells starting at the given columns of a row
+        raise NotImplementedError
+
+    def write_block(self, row: int, column: int, values: list[list]):
+        raise NotImplementedError
+
+    def save(self):
+        raise NotImplementedError
+
+
+class XlwingsBackend(SheetBackend):
+    def __init__(self, sheet: 'xw.Sheet'):
+        self._sheet = sheet
+
+    @property
+    def sheet(self) -> 'xw.Sheet':
+        return self._sheet
+
+    @property
+    def name(self) -> str:
+        return self._sheet.name
+
+    def read_grid(self) -> list[list]:
+        max_row = self._sheet.used_range.last_cell.row
+        max_column = self._sheet.range('A1').merge_area.last_cell.column
+
+        return self._sheet.range('A1', (max_row, max_column)).options(ndim=2).value
+
+    def merge_areas(self, row: int, columns: list[int]) -> dict[int, int]:
+        merges = {}
+        for col in columns:
+            cell = self._sheet.range((row, col))
+            if cell.merge_cells:
+                merges[col] = cell.merge_area.last_cell.column
+
+        return merges
+
+    def write_block(self, row: int, column: int, values: list[list]):
+        self._sheet.range((row, column)).value = values
+
+    def save(self):
+        self._sheet.book.save()
+
+
+class GridBackend(SheetBackend):
+    def __init__(self, grid: list[list], merges: list[tuple[int, int, int, int]] = None, name=None):
+        width = max((len(row) for row in grid), default=0)
+        self.grid = [list(row) + [None] * (width - len(row)) for row in grid]
+        self.merges = merges if merges is not None else []  # (first_row, first_col, last_row, last_col)
+        self.saves = 0
+        self._name = name
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def read_grid(self) -> list[list]:
+        return [list(row) for row in self.grid]
+
+    def merge_areas(self, row: int, columns: list[int]) -> dict[int, int]:
+        return {first_col: last_col for first_row, first_col, last_row, last_col in self.merges
+                if first_row == row and first_col in columns}
+
+    def write_block(self, row: int, column: int, values: list[list]):
+        for row_idx, data in enumerate(values, start=row - 1):
+            if row_idx >= len(self.grid):
+                self.grid.extend([] for _ in range(row_idx - len(self.grid) + 1))
+            line = self.grid[row_idx]
+            if column - 1 + len(data) > len(line):
+                line.extend([None] * (column - 1 + len(data) - len(line)))
+            line[column - 1:column - 1 + len(data)] = data
+
+    def save(self):
+        self.saves += 1
+
+
+class XlwingsWorkbook:
+    # an Excel workbook opened in its own hidden Excel instance
+    def __init__(self, path: str, visible=False):
+        import xlwings as xw
+
+        self.path = path
+        self._app = xw.App(visible=visible, add_book=False)
+        self._book = self._app.books.open(path, update_links=False)
+
+    @property
+    def book(self) -> 'xw.Book':
+        return self._book
+
+    @property
+    def sheet_names(self) -> list[str]:
+        return [sheet.name for sheet in self._book.sheets]
+
+    def sheet(self, name: str) -> XlwingsBackend:
+        return XlwingsBackend(self._book.sheets[name])
+
+    def save(self, path: str = None):
+        self._book.save(path)
+
+    def close(self):
+        self._book.close()
+        self._app.quit()
+
+
+class GridWorkbook:
+    # in-memory sheets with the workbook interface, for tools that run without Excel or files
+    def __init__(self, sheets: dict[str, tuple[list[list], list[tuple]]]):
+        self._sheets = {name: GridBackend(grid, merges, name=name) for name, (grid, merges) in sheets.items()}
+        self.saves = 0
+
+    @property
+    def sheet_names(self) -> list[str]:
+        return list(self._sheets)
+
+    def sheet(self, name: str) -> GridBackend:
+        return self._sheets[name]
+
+    def save(self, path: str = None):
+        self.saves += 1
+
+    def close(self):
+        pass
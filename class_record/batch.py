@@ -0,0 +1,207 @@
+import csv
+import glob
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+from class_record.cache import content_hash
+from class_record.cli import RANDOMIZER_MAX_LOOP
+from class_record.cli import RANDOMIZER_MODE
+from class_record.cli import RANDOMIZER_THRESHOLD
+from class_record.cli import apply_targets
+from class_record.cli import open_workbook
+from class_record.cli import sheet_targets
+from class_record.randomizer import SolutionPool
+from class_record.stats import RunStats
+
+SUMMARY_NAME = 'classgenie-batch.jsonl'
+
+
+def find_workbooks(patterns: list[str]) -> list[str]:
+    # directories give the .xlsx files directly in them, anything else is a glob; Excel lock files (~$...) are skipped
+    found = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(glob.escape(pattern), '*.xlsx')
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            path = os.path.abspath(path)
+            if os.path.isfile(path) and not os.path.basename(path).startswith('~$') and path not in found:
+                found.append(path)
+
+    return found
+
+
+def read_manifest(path: str) -> dict:
+    # csv with workbook, sheet, name, grade and offset columns, all optional but for grade/offset: a row with a name
+    # and grade sets a learner's target, a row with an offset and no name moves the other learners of the sheet (or of
+    # every sheet when sheet is blank); a blank workbook applies to every workbook, otherwise it is the file name
+    # returns {workbook file name or None: {'targets': {sheet or None: {name: grade}}, 'offsets': {sheet or None: n}}}
+    manifest = {}
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        columns = set(reader.fieldnames or [])
+        if not columns & {'grade', 'offset'}:
+            raise ValueError('{} needs a grade or an offset column'.format(path))
+
+        for line, row in enumerate(reader, start=2):
+            workbook = (row.get('workbook') or '').strip() or None
+            sheet = (row.get('sheet') or '').strip() or None
+            name = (row.get('name') or '').strip()
+            grade = (row.get('grade') or '').strip()
+            offset = (row.get('offset') or '').strip()
+            entry = manifest.setdefault(workbook, dict(targets={}, offsets={}))
+            if name and grade:
+                entry['targets'].setdefault(sheet, {})[name] = int(grade)
+            elif offset and not name:
+                entry['offsets'][sheet] = int(offset)
+            elif name or grade or offset:
+                raise ValueError('{}:{}: a row needs a name and a grade, or an offset alone'.format(path, line))
+
+    return manifest
+
+
+def workbook_plan(manifest: dict, path: str) -> dict:
+    # the manifest entries for one workbook, the rows naming it override the ones for every workbook
+    plan = dict(targets={}, offsets={})
+    for key in (None, os.path.basename(path)):
+        entry = manifest.get(key)
+        if entry is None:
+            continue
+        for sheet, grades in entry['targets'].items():
+            plan['targets'].setdefault(sheet, {}).update(grades)
+        plan['offsets'].update(entry['offsets'])
+
+    return plan
+
+
+def process_workbook(path: str, plan: dict, output: str = None, cache=True, dry_run=False, **options) -> dict:
+    # runs in a pool worker: every sheet is parsed once, randomized, written back and the book saved once
+    # returns the summary of the file, errors that stop the file are reported in it instead of raised
+    start = time.perf_counter()
+    stats = RunStats('batch:{}'.format(os.path.basename(path)))
+    summary = dict(path=path, output=output or path, status='dry-run' if dry_run else 'done', sheets=0, learners=0,
+                   targeted=0, changed=0, failed=0, failures=[], error=None)
+    options = dict(options, workers=1, pool=SolutionPool())
+    book = None
+    try:
+        with stats.phase('open'):
+            book = open_workbook(path, cache=cache)
+        for name in book.sheet_names:
+            grades = sheet_targets(plan['targets'], name)
+            offset = plan['offsets'].get(name, plan['offsets'].get(None))
+            if not grades and offset is None:
+                continue
+
+            cs = book.class_sheet(name)
+            applied, failures = apply_targets(cs, grades, offset, stats=stats, **options)
+            summary['sheets'] += 1
+            summary['learners'] += len(cs.student_records)
+            summary['targeted'] += len(applied)
+            summary['changed'] += sum(any(component.modified for component in sr.components)
+                                      for sr in cs.student_records)
+            summary['failed'] += len(failures)
+            summary['failures'].extend([name, cs.student_records[idx].name, error]
+                                       for idx, error in sorted(failures.items()))
+            cs.write_sheet()
+            stats.merge(cs.take_stats())
+
+        if not dry_run:
+            with stats.phase('save'):
+                book.save(output)
+            summary['sha256'] = content_hash(output or path)
+    except Exception as e:
+        summary.update(status='failed', error='{}: {}'.format(type(e).__name__, e),
+                       traceback=traceback.format_exc())
+    finally:
+        if book is not None:
+            book.close()
+
+    summary.update(seconds=round(time.perf_counter() - start, 3), stats=stats.as_dict())
+    return summary
+
+
+def load_summary(path: str) -> dict[str, dict]:
+    # the last summary of each file in a summary log, a log cut short by an interruption loses at most its last line
+    found = {}
+    if not os.path.exists(path):
+        return found
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                summary = json.loads(line)
+            except ValueError:
+                continue
+            found[summary['path']] = summary
+
+    return found
+
+
+def _saved_in_place(summary: dict) -> bool:
+    # a workbook whose content changed since its run started in place was saved by the worker, the run stopped before
+    # the result was logged
+    return summary['status'] == 'started' and summary.get('sha256') is not None and os.path.isfile(summary['path']) \
+        and content_hash(summary['path']) != summary['sha256']
+
+
+def _log(log, summary: dict):
+    log.write(json.dumps(summary, separators=(',', ':'), default=str) + '\n')
+    log.flush()
+
+
+def run_batch(paths: list[str], manifest: dict, summary_path: str, output_dir: str = None, jobs: int = None,
+              resume=True, cache=True, dry_run=False, on_done=None, **options) -> list[dict]:
+    # one job per workbook on a process pool, each finished file is appended to the summary log right away so an
+    # interrupted run resumes with the files not done yet; on_done(summary) is called as files finish
+    # a file saved in place is logged as started with its content hash before its job runs, so one saved just before
+    # an interruption is recognized on resume and its offsets are not applied a second time
+    # returns the summaries of the files processed in this run
+    logged = load_summary(summary_path) if resume else {}
+    done = {path for path, summary in logged.items() if summary['status'] == 'done'}
+    wanted = set(paths)
+    recovered = [summary for path, summary in logged.items() if path in wanted and _saved_in_place(summary)]
+    done.update(summary['path'] for summary in recovered)
+    pending = [path for path in paths if path not in done]
+    options = dict(dict(threshold=RANDOMIZER_THRESHOLD, max_loop=RANDOMIZER_MAX_LOOP, mode=RANDOMIZER_MODE),
+                   **options)
+
+    summaries = []
+    if not pending and not recovered:
+        return summaries
+
+    for directory in (output_dir, os.path.dirname(os.path.abspath(summary_path))):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    with open(summary_path, 'a', encoding='utf-8') as log:
+        for summary in recovered:
+            _log(log, dict(summary, status='done', recovered=True, sha256=content_hash(summary['path'])))
+        if not pending:
+            return summaries
+
+        outputs = {path: os.path.join(output_dir, os.path.basename(path)) if output_dir else None
+                   for path in pending}
+        for path in pending:
+            in_place = outputs[path] is None and not dry_run
+            _log(log, dict(path=path, output=outputs[path] or path, status='started',
+                           sha256=content_hash(path) if in_place else None))
+
+        jobs = min(jobs or os.cpu_count() or 1, len(pending))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(process_workbook, path, workbook_plan(manifest, path), outputs[path], cache,
+                                       dry_run, **options): path for path in pending}
+            try:
+                for future in as_completed(futures):
+                    summary = future.result()
+                    _log(log, summary)
+                    summaries.append(summary)
+                    if on_done is not None:
+                        on_done(summary)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    return summaries
@@ -0,0 +1,234 @@
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+from class_record import ClassSheet
+from class_record import transmute_grade
+from class_record.backends import GridBackend
+from class_record.randomizer import MaximumLoopReached
+from class_record.randomizer import randomize_student_record
+from class_record.randomizer import reachable_grades
+from class_record.synthetic import class_grid
+from class_record.synthetic import write_workbook
+from class_record.xlsx import XlsxWorkbook
+
+# timings are machine specific, the stored baseline is refreshed with `python -m class_record bench --save-baseline`
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'resources', 'benchmark_baseline.json')
+BENCHMARK_LEARNERS = 500
+BENCHMARK_REPEAT = 5
+BENCHMARK_TOLERANCE = 0.5
+
+RANDOMIZER_MAX_LOOP = 5_000
+RANDOMIZER_LEARNERS = 20
+RANDOMIZER_THRESHOLD = 1.6
+
+# entry points whose import time is tracked, each is timed in a fresh interpreter
+IMPORT_MODULES = ('class_record', 'class_record.workbook', 'class_record.randomizer', 'class_record.parallel')
+
+Timing = namedtuple('Timing', ['name', 'best', 'median', 'runs'])
+ImportTime = namedtuple('ImportTime', ['module', 'self', 'cumulative', 'depth'])
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+    # registers setup(learners, directory) returning the function to time, it is called once per run. directory is
+    # a temporary directory for the files of the benchmark, it is removed once the benchmark has run
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def _grid(learners: int, blanks=0.0) -> tuple[list[list], list[tuple]]:
+    return class_grid(learners // 2, learners - learners // 2, blanks=blanks, seed=learners)
+
+
+@benchmark('transmute_grade')
+def _transmute_grade(learners: int, directory: str):
+    grades = [idx / 100 for idx in range(10_001)] * 10
+
+    def run():
+        for grade in grades:
+            transmute_grade(grade)
+
+    return run
+
+
+@benchmark('parse_grid')
+def _parse_grid(learners: int, directory: str):
+    grid, merges = _grid(learners)
+
+    def run():
+        ClassSheet(GridBackend(grid, merges)).student_records
+
+    return run
+
+
+@benchmark('parse_xlsx')
+def _parse_xlsx(learners: int, directory: str):
+    path = os.path.join(directory, 'class.xlsx')
+    write_workbook(path, {'CLASS': _grid(learners)})
+
+    def run():
+        ClassSheet(XlsxWorkbook(path).sheet('CLASS')).student_records
+
+    return run
+
+
+def _randomize(learners: int, target, mode: str, overwrite_all: bool):
+    # a third of the scores are blank, so keeping the existing scores still leaves items to fill
+    grid, merges = _grid(learners, blanks=0.3)
+    cs = ClassSheet(GridBackend(grid, merges))
+    # a fixed slice of the class, the slow modes would otherwise dominate the suite
+    records = [record for record in cs.student_records if record.transmuted_average is not None]
+    records = records[:RANDOMIZER_LEARNERS]
+    targets = [target(record, cs.head_components) for record in records]
+    scores = [[list(component.scores) for component in record.components] for record in records]
+
+    def run():
+        rng = random.Random(0)
+        for record, target, saved in zip(records, targets, scores):
+            for component, component_scores in zip(record.components, saved):
+                component.scores = list(component_scores)
+            try:
+                randomize_student_record(record, target, cs.head_components, max_loop=RANDOMIZER_MAX_LOOP,
+                                         threshold=RANDOMIZER_THRESHOLD, overwrite_all=overwrite_all, mode=mode,
+                                         rng=rng)
+            except MaximumLoopReached:
+                pass
+
+    return run
+
+
+def _easy_target(record, head_components) -> int:
+    return record.transmuted_average + 1
+
+
+def _hard_target(record, head_components) -> int:
+    # the best grade the learner can still reach while keeping the existing scores
+    return max(reachable_grades(record, head_components, RANDOMIZER_THRESHOLD, overwrite_all=False))
+
+
+# easy targets move a learner up a grade, hard ones ask for the top reachable grade while keeping the existing scores
+for _mode in ('sample', 'direct', 'batch'):
+    benchmark('randomize_easy_{}'.format(_mode))(
+        lambda learners, directory, mode=_mode: _randomize(learners, _easy_target, mode, overwrite_all=True))
+    benchmark('randomize_hard_{}'.format(_mode))(
+        lambda learners, directory, mode=_mode: _randomize(learners, _hard_target, mode, overwrite_all=False))
+
+
+def _modify(cs: ClassSheet, rng: random.Random):
+    # new scores for the first component of every learner
+    highest_scores = cs.head_components[0].scores
+    for record in cs.student_records:
+        record.components[0].scores = [rng.randint(0, int(highest)) for highest in highest_scores]
+
+
+@benchmark('save_sheet_grid')
+def _save_sheet_grid(learners: int, directory: str):
+    grid, merges = _grid(learners)
+    rng = random.Random(0)
+
+    def run():
+        cs = ClassSheet(GridBackend(grid, merges))
+        _modify(cs, rng)
+        cs.save_sheet()
+
+    return run
+
+
+@benchmark('save_sheet_xlsx')
+def _save_sheet_xlsx(learners: int, directory: str):
+    path = os.path.join(directory, 'class.xlsx')
+    write_workbook(path, {'CLASS': _grid(learners)})
+    cs = ClassSheet(XlsxWorkbook(path).sheet('CLASS'))
+    rng = random.Random(0)
+
+    def run():
+        _modify(cs, rng)
+        cs.save_sheet()
+
+    return run
+
+
+def _python(*args) -> subprocess.CompletedProcess:
+    # a fresh interpreter that imports this package from the tree the benchmarks run from
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (root, os.environ.get('PYTHONPATH')))))
+    return subprocess.run([sys.executable, *args], env=env, capture_output=True, text=True, check=True)
+
+
+def import_times(module: str) -> list[ImportTime]:
+    # every module imported by `import module` in a fresh interpreter, from python -X importtime, in seconds
+    found = []
+    for line in _python('-X', 'importtime', '-c', 'import {}'.format(module)).stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        found.append(ImportTime(module=name.strip(), self=int(own) / 1e6, cumulative=int(cumulative) / 1e6,
+                                depth=(len(name) - len(name.lstrip()) - 1) // 2))
+
+    return found
+
+
+def _import_module(learners: int, directory: str, module: str):
+    # interpreter start included, it is what a user waits for before the first line runs
+    def run():
+        _python('-c', 'import {}'.format(module))
+
+    return run
+
+
+for _module in IMPORT_MODULES:
+    benchmark('import_{}'.format(_module.replace('.', '_')))(
+        lambda learners, directory, module=_module: _import_module(learners, directory, module))
+
+
+def run_benchmark(name: str, learners=BENCHMARK_LEARNERS, repeat=BENCHMARK_REPEAT) -> Timing:
+    with tempfile.TemporaryDirectory(prefix='classgenie-bench-') as directory:
+        fn = BENCHMARKS[name](learners, directory)
+        fn()  # warm up, the first run pays for imports and caches
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            runs.append(time.perf_counter() - start)
+
+    return Timing(name=name, best=min(runs), median=statistics.median(runs), runs=runs)
+
+
+def run_benchmarks(names: list[str] = None, learners=BENCHMARK_LEARNERS, repeat=BENCHMARK_REPEAT) -> list[Timing]:
+    return [run_benchmark(name, learners, repeat) for name in (names if names is not None else BENCHMARKS)]
+
+
+def load_baseline(path: str = BASELINE_PATH) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(timings: list[Timing], learners: int, path: str = BASELINE_PATH):
+    baseline = dict(learners=learners, python=platform.python_version(), machine=platform.machine(),
+                    processor=platform.processor() or None, results={timing.name: timing.best for timing in timings})
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def regressions(timings: list[Timing], baseline: dict, tolerance=BENCHMARK_TOLERANCE) -> list[tuple[str, float, float]]:
+    # (name, best time, baseline time) of the benchmarks slower than the baseline by more than tolerance
+    found = []
+    for timing in timings:
+        expected = baseline['results'].get(timing.name)
+        if expected is not None and timing.best > expected * (1 + tolerance):
+            found.append((timing.name, timing.best, expected))
+
+    return found
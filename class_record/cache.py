@@ -0,0 +1,250 @@
+import glob
+import hashlib
+import json
+import os
+import struct
+import sys
+from array import array
+from numbers import Number
+from typing import Optional
+
+from class_record import ClassSheet
+from class_record import Component
+from class_record import ComponentColumns
+from class_record import StudentRecord
+from class_record.backends import SheetBackend
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'classgenie')
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_SUFFIX = '.cgc'
+
+# magic, format version, length of the json metadata; the learners' scores follow the metadata as little endian
+# float64, learners x items with NaN for blank scores
+_HEADER = struct.Struct('<4sHI')
+_MAGIC = b'CGPC'
+_VERSION = 1
+
+_HASH_CHUNK = 1024 * 1024
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def _key(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def content_hash(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def _number(value) -> bool:
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def dump_class_sheet(cs: ClassSheet, source: dict) -> bytes:
+    # source is the path, size, mtime_ns and hash of the workbook the sheet was parsed from
+    scores = array('d')
+    extras = []
+    for row, record in enumerate(cs.student_records):
+        col = 0
+        for component in record.components:
+            for score in component.scores:
+                if score is None:
+                    scores.append(float('nan'))
+                elif _number(score):
+                    scores.append(score)
+                else:
+                    # text and the like in a score cell, kept aside so the scores stay a plain float array
+                    scores.append(float('nan'))
+                    extras.append([row, col, score])
+                col += 1
+
+    metadata = dict(source,
+                    label_row=cs.label_row,
+                    label_components=[list(columns) for columns in cs.label_components],
+                    head_components=[[head.label, head.scores, head.highest_total_score, head.weight]
+                                     for head in cs.head_components],
+                    student_rows=cs.student_rows,
+                    names=[record.name for record in cs.student_records],
+                    extras=extras)
+    metadata = json.dumps(metadata, separators=(',', ':')).encode('utf-8')
+    if sys.byteorder == 'big':
+        scores.byteswap()
+
+    return _HEADER.pack(_MAGIC, _VERSION, len(metadata)) + metadata + scores.tobytes()
+
+
+def load_metadata(data: bytes) -> tuple[dict, int]:
+    # returns the metadata and the offset of the scores, raises ValueError on anything but a cache entry
+    if len(data) < _HEADER.size:
+        raise ValueError('Truncated cache entry.')
+    magic, version, length = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError('Not a cache entry of this version.')
+
+    end = _HEADER.size + length
+    return json.loads(data[_HEADER.size:end].decode('utf-8')), end
+
+
+def load_class_sheet(data: bytes, sheet: SheetBackend, on_save=None) -> ClassSheet:
+    metadata, offset = load_metadata(data)
+
+    scores = array('d')
+    scores.frombytes(data[offset:])
+    if sys.byteorder == 'big':
+        scores.byteswap()
+
+    label_components = [ComponentColumns(*columns) for columns in metadata['label_components']]
+    head_components = [Component(scores=head_scores, weight=weight, highest_total_score=highest_total_score,
+                                 label=label)
+                       for label, head_scores, highest_total_score, weight in metadata['head_components']]
+    widths = [len(head.scores) for head in head_components]
+    width = sum(widths)
+    names = metadata['names']
+    if len(scores) != len(names) * width:
+        raise ValueError('Truncated cache entry.')
+
+    values = [None if score != score else score for score in scores]
+    for row, col, value in metadata['extras']:
+        values[row * width + col] = value
+
+    student_records = []
+    for row, name in enumerate(names):
+        components = []
+        start = row * width
+        for head, size in zip(head_components, widths):
+            components.append(Component(scores=values[start:start + size], weight=head.weight,
+                                        highest_total_score=head.highest_total_score, label=head.label))
+            start += size
+        student_records.append(StudentRecord(name=name, components=components))
+
+    return ClassSheet.from_parsed(sheet, metadata['label_row'], label_components, head_components,
+                                  metadata['student_rows'], student_records, on_save=on_save)
+
+
+class ParseCache:
+    # parsed ClassSheets on disk, one file per workbook sheet, valid while the workbook has the same content.
+    # the size and mtime are checked first and the content hash only when they differ, so a touched but unchanged
+    # workbook is still found. the least recently used files go once the directory is over max_bytes
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._hashes = {}
+
+    def entry_path(self, path: str, sheet_name: str) -> str:
+        return os.path.join(self.directory, '{}-{}{}'.format(_digest(_key(path)), _digest(sheet_name), CACHE_SUFFIX))
+
+    def source(self, path: str) -> dict:
+        stat = os.stat(path)
+        return dict(path=_key(path), size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                    hash=self._content_hash(path, stat.st_size, stat.st_mtime_ns))
+
+    def _content_hash(self, path: str, size: int, mtime_ns: int) -> str:
+        # hashed once per version of the file, a workbook is looked up once for each of its sheets
+        key = (_key(path), size, mtime_ns)
+        found = self._hashes.get(key)
+        if found is None:
+            found = self._hashes[key] = content_hash(path)
+
+        return found
+
+    def _is_current(self, path: str, metadata: dict) -> bool:
+        stat = os.stat(path)
+        if metadata['path'] != _key(path) or metadata['size'] != stat.st_size:
+            return False
+        if metadata['mtime_ns'] == stat.st_mtime_ns:
+            return True
+
+        return metadata['hash'] == self._content_hash(path, stat.st_size, stat.st_mtime_ns)
+
+    def load(self, path: str, sheet_name: str, sheet: SheetBackend, on_save=None) -> Optional[ClassSheet]:
+        entry = self.entry_path(path, sheet_name)
+        try:
+            with open(entry, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        try:
+            metadata, _ = load_metadata(data)
+            if not self._is_current(path, metadata):
+                self._remove(entry)
+                return None
+            cs = load_class_sheet(data, sheet, on_save=on_save)
+        except (ValueError, KeyError, TypeError, struct.error):
+            self._remove(entry)
+            return None
+
+        # the modification time orders the entries for eviction
+        os.utime(entry)
+        return cs
+
+    def store(self, path: str, sheet_name: str, cs: ClassSheet) -> bool:
+        try:
+            data = dump_class_sheet(cs, self.source(path))
+        except TypeError:
+            # a value json cannot hold, such as a date, the sheet is parsed every time instead
+            return False
+
+        os.makedirs(self.directory, exist_ok=True)
+        entry = self.entry_path(path, sheet_name)
+        temp = entry + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, entry)
+
+        self.evict()
+        return True
+
+    def invalidate(self, path: str, sheet_name: str = None):
+        if sheet_name is not None:
+            self._remove(self.entry_path(path, sheet_name))
+            return
+
+        for entry in glob.glob(os.path.join(glob.escape(self.directory), _digest(_key(path)) + '-*' + CACHE_SUFFIX)):
+            self._remove(entry)
+
+    def entries(self) -> list[tuple[str, int, float]]:
+        # (file, size, last used) of every entry, least recently used first
+        entries = []
+        for entry in glob.glob(os.path.join(glob.escape(self.directory), '*' + CACHE_SUFFIX)):
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((entry, stat.st_size, stat.st_mtime))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for entry, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(entry)
+            total -= size
+
+    def clear(self):
+        for entry, _, _ in self.entries():
+            self._remove(entry)
+
+    @staticmethod
+    def _remove(entry: str):
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return "<ParseCache(directory='{}', max_bytes='{}')>".format(self.directory, self.max_bytes)
@@ -0,0 +1,374 @@
+import argparse
+import csv
+import os
+import sys
+
+from class_record import ClassSheet
+from class_record.cache import ParseCache
+from class_record.randomizer import SolutionPool
+from class_record.stats import STATS_LOG_ENV
+from class_record.stats import RunStats
+from class_record.workbook import ClassWorkbook
+
+RANDOMIZER_MAX_LOOP = 100_000
+RANDOMIZER_THRESHOLD = 1.6
+RANDOMIZER_MODE = 'direct'
+RANDOMIZER_MODES = ('direct', 'batch', 'sample')
+
+
+def open_workbook(path: str, excel=False, cache=True) -> ClassWorkbook:
+    return ClassWorkbook(path, excel=excel, cache=ParseCache() if cache else None)
+
+
+def read_targets(path: str) -> dict:
+    # csv with name and grade columns, and an optional sheet column; learners without a sheet apply to all sheets
+    # returns {sheet name or None: {learner name: grade}}
+    targets = {}
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        missing = {'name', 'grade'} - set(reader.fieldnames or [])
+        if missing:
+            raise ValueError('{} is missing the column(s): {}'.format(path, ', '.join(sorted(missing))))
+
+        for row in reader:
+            if not (row['name'] or '').strip() or not (row['grade'] or '').strip():
+                continue
+            sheet = (row.get('sheet') or '').strip() or None
+            targets.setdefault(sheet, {})[row['name'].strip()] = int(row['grade'])
+
+    return targets
+
+
+def sheet_targets(targets: dict, sheet_name: str) -> dict[str, int]:
+    grades = dict(targets.get(None, {}))
+    grades.update(targets.get(sheet_name, {}))
+    return grades
+
+
+def apply_targets(cs: ClassSheet, grades: dict[str, int], offset: int = None, **options) -> tuple[dict, dict]:
+    # learners named in grades get that grade, the others are moved by offset when one is given
+    # returns ({learner index: target}, {learner index: error})
+    # numpy and the process pool are only loaded once scores are generated
+    from class_record.parallel import randomize_class
+
+    targets = {}
+    for idx, sr in enumerate(cs.student_records):
+        name = str(sr.name).strip()
+        if name in grades:
+            targets[idx] = grades[name]
+        elif offset is not None and sr.transmuted_average is not None:
+            targets[idx] = sr.transmuted_average + offset
+
+    return targets, randomize_class(cs, targets, **options)
+
+
+def apply(args) -> int:
+    targets = read_targets(args.targets) if args.targets else {}
+    if not targets and args.offset is None:
+        print('Nothing to do, give --targets and/or --offset.', file=sys.stderr)
+        return 2
+
+    options = dict(workers=args.workers, seed=args.seed, max_loop=args.max_loop, threshold=args.threshold,
+                   overwrite_all=not args.keep_existing, mode=args.mode,
+                   pool=None if args.no_pool else SolutionPool())
+
+    book = open_workbook(args.workbook, excel=args.excel, cache=not args.no_cache)
+    failed = 0
+    total = RunStats('apply')
+    try:
+        names = args.sheets.split(',') if args.sheets else book.sheet_names
+        unknown = [name for name in names if name not in book.sheet_names]
+        if unknown:
+            print('Unknown sheet(s): {}'.format(', '.join(unknown)), file=sys.stderr)
+            return 2
+
+        for name in names:
+            stats = RunStats('apply:{}'.format(name))
+            with stats.phase('open'):
+                cs = book.class_sheet(name)
+            grades = sheet_targets(targets, name)
+            learners = {str(sr.name).strip() for sr in cs.student_records}
+            for missing in sorted(set(targets.get(name, {})) - learners):
+                print('{}: no learner named {!r}'.format(name, missing), file=sys.stderr)
+
+            applied, failures = apply_targets(cs, grades, args.offset, stats=stats, **options)
+            changed = sum(any(component.modified for component in sr.components) for sr in cs.student_records)
+            report = cs.write_sheet()
+            failed += len(failures)
+
+            print('{}: {} learners, {} targeted, {} changed, {} failed, {} cells in {} writes'.format(
+                name, len(cs.student_records), len(applied), changed, len(failures), report.cells,
+                report.calls))
+            for idx, error in sorted(failures.items()):
+                print('{}: {}: {}'.format(name, cs.student_records[idx].name, error), file=sys.stderr)
+
+            stats.merge(cs.take_stats())
+            if args.stats:
+                print('{}: {}'.format(name, stats.summary()))
+            stats.log(args.stats_log)
+            total.merge(stats)
+
+        if not args.dry_run:
+            with total.phase('save'):
+                book.save(args.output)
+    finally:
+        book.close()
+
+    if args.stats:
+        print('total: {}'.format(total.summary()))
+    total.log(args.stats_log)
+
+    return 1 if failed else 0
+
+
+def bench(args) -> int:
+    # the synthetic classes and their xlsx writer are only loaded to run the benchmarks
+    from class_record import benchmark
+
+    for name, default in (('learners', benchmark.BENCHMARK_LEARNERS), ('repeat', benchmark.BENCHMARK_REPEAT),
+                          ('tolerance', benchmark.BENCHMARK_TOLERANCE), ('baseline', benchmark.BASELINE_PATH)):
+        if getattr(args, name) is None:
+            setattr(args, name, default)
+
+    names = args.only.split(',') if args.only else None
+    unknown = [name for name in names or [] if name not in benchmark.BENCHMARKS]
+    if unknown:
+        print('Unknown benchmark(s): {}'.format(', '.join(unknown)), file=sys.stderr)
+        return 2
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        baseline = benchmark.load_baseline(args.baseline)
+        if baseline['learners'] != args.learners:
+            print('The baseline was taken with {} learners, comparing anyway.'.format(baseline['learners']),
+                  file=sys.stderr)
+
+    timings = []
+    for name in names if names is not None else benchmark.BENCHMARKS:
+        timing = benchmark.run_benchmark(name, args.learners, args.repeat)
+        timings.append(timing)
+        expected = baseline['results'].get(name) if baseline is not None else None
+        print('{:<24} best {:>9.4f}s  median {:>9.4f}s{}'.format(
+            name, timing.best, timing.median, '  baseline {:.4f}s ({:+.0%})'.format(
+                expected, timing.best / expected - 1) if expected else ''))
+
+    if args.save_baseline:
+        benchmark.save_baseline(timings, args.learners, args.baseline)
+        print('Saved the baseline to {}'.format(args.baseline))
+        return 0
+
+    if baseline is not None:
+        found = benchmark.regressions(timings, baseline, args.tolerance)
+        for name, best, expected in found:
+            print('{}: {:.4f}s is slower than the baseline {:.4f}s'.format(name, best, expected), file=sys.stderr)
+        return 1 if found else 0
+
+    return 0
+
+
+def imports(args) -> int:
+    # the import time of each entry point and the modules it spends the most time in, best of args.repeat runs
+    from class_record import benchmark
+
+    for module in args.modules.split(',') if args.modules else benchmark.IMPORT_MODULES:
+        runs = []
+        for _ in range(args.repeat):
+            times = benchmark.import_times(module)
+            total = next(entry.cumulative for entry in times if entry.module == module and entry.depth == 0)
+            runs.append((total, times))
+        total, times = min(runs, key=lambda run: run[0])
+
+        print('{:<32} {:>8.1f}ms'.format(module, total * 1000))
+        for entry in sorted((entry for entry in times if entry.depth > 0), key=lambda entry: -entry.self)[:args.top]:
+            print('    {:<40} self {:>7.1f}ms  cumulative {:>7.1f}ms'.format(entry.module, entry.self * 1000,
+                                                                           entry.cumulative * 1000))
+
+    return 0
+
+
+def batch(args) -> int:
+    from class_record import batch as batch_run
+
+    paths = batch_run.find_workbooks(args.workbooks)
+    if args.output_dir:
+        output_dir = os.path.abspath(args.output_dir)
+        paths = [path for path in paths if os.path.dirname(path) != output_dir]
+    if not paths:
+        print('No workbooks found.', file=sys.stderr)
+        return 2
+    manifest = batch_run.read_manifest(args.manifest) if args.manifest else {}
+    if args.offset is not None:
+        manifest.setdefault(None, dict(targets={}, offsets={}))['offsets'].setdefault(None, args.offset)
+    if not manifest:
+        print('Nothing to do, give --manifest and/or --offset.', file=sys.stderr)
+        return 2
+
+    summary_path = args.summary or os.path.join(args.output_dir or os.path.dirname(paths[0]),
+                                                batch_run.SUMMARY_NAME)
+    done = len(paths)
+
+    def show(summary):
+        print('{status:<7} {seconds:>7.2f}s  {sheets} sheets, {learners} learners, {targeted} targeted, {changed} '
+              'changed, {failed} failed  {path}'.format(**summary))
+        if summary['error']:
+            print('    {}'.format(summary['error']), file=sys.stderr)
+        for sheet, learner, error in summary['failures']:
+            print('    {}: {}: {}'.format(sheet, learner, error), file=sys.stderr)
+
+    summaries = batch_run.run_batch(paths, manifest, summary_path, output_dir=args.output_dir, jobs=args.jobs,
+                                    resume=not args.restart, cache=not args.no_cache, dry_run=args.dry_run,
+                                    on_done=show, seed=args.seed, max_loop=args.max_loop,
+                                    threshold=args.threshold, overwrite_all=not args.keep_existing, mode=args.mode)
+    skipped = done - len(summaries)
+    errors = sum(summary['status'] == 'failed' for summary in summaries)
+    print('{} workbooks, {} skipped as done, {} failed, {} learners not generated, summary in {}'.format(
+        done, skipped, errors, sum(summary['failed'] for summary in summaries), summary_path))
+
+    return 1 if errors or any(summary['failed'] for summary in summaries) else 0
+
+
+def export(args) -> int:
+    from class_record import export as export_run
+    from class_record.batch import find_workbooks
+
+    paths = find_workbooks(args.workbooks)
+    if not paths:
+        print('No workbooks found.', file=sys.stderr)
+        return 2
+
+    stats = RunStats('export')
+    failed = []
+
+    def skip(path, error):
+        failed.append(path)
+        print('{}: {}: {}'.format(path, type(error).__name__, error), file=sys.stderr)
+
+    try:
+        count = export_run.export(paths, args.output, fmt=args.format,
+                                  sheet_names=args.sheets.split(',') if args.sheets else None,
+                                  components=args.components, jobs=args.jobs, stats=stats, on_error=skip)
+    except ImportError as e:
+        print(e, file=sys.stderr)
+        return 2
+    stats.log(args.stats_log)
+    print('{} learners of {} workbooks exported to {} in {:.2f}s, {} workbooks failed'.format(
+        count, len(paths) - len(failed), args.output, stats.elapsed, len(failed)))
+
+    return 1 if failed else 0
+
+
+def serve(args) -> int:
+    import asyncio
+
+    from class_record.service import GradingService
+
+    service = GradingService(workers=args.workers, cache=not args.no_cache)
+    print('Serving on http://{}:{}/sessions'.format(args.host, args.port), file=sys.stderr)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.shutdown()
+
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m class_record', description='Class Genie without the GUI.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_apply = commands.add_parser('apply', help='generate scores for the learners of a workbook and save it')
+    parser_apply.add_argument('workbook', help='.xlsx class record')
+    parser_apply.add_argument('--targets', help='csv with name, grade and optional sheet columns')
+    parser_apply.add_argument('--sheets', help='comma separated sheet names, all sheets by default')
+    parser_apply.add_argument('--offset', type=int, help='move the grade of learners without a target by this much')
+    parser_apply.add_argument('--keep-existing', action='store_true', help='only fill blank scores')
+    parser_apply.add_argument('--threshold', type=float, default=RANDOMIZER_THRESHOLD)
+    parser_apply.add_argument('--max-loop', type=int, default=RANDOMIZER_MAX_LOOP)
+    parser_apply.add_argument('--mode', choices=RANDOMIZER_MODES, default=RANDOMIZER_MODE)
+    parser_apply.add_argument('--workers', type=int, default=1)
+    parser_apply.add_argument('--seed', type=int)
+    parser_apply.add_argument('--output', help='save to this path instead of overwriting the workbook')
+    parser_apply.add_argument('--dry-run', action='store_true', help='report without saving')
+    parser_apply.add_argument('--excel', action='store_true', help='go through Excel (xlwings) instead of reading '
+                                                                   'the .xlsx directly')
+    parser_apply.add_argument('--no-pool', action='store_true', help='search every learner anew instead of reusing '
+                                                                      'the scores found for the same grade')
+    parser_apply.add_argument('--stats', action='store_true', help='print backend calls, randomizer iterations and '
+                                                                    'phase times of each sheet')
+    parser_apply.add_argument('--stats-log', help='append the stats of each sheet and of the whole run as JSON lines '
+                                                  'to this file (default ${})'.format(STATS_LOG_ENV))
+    parser_apply.add_argument('--no-cache', action='store_true', help='parse every sheet instead of loading sheets '
+                                                                       'parsed before from the cache')
+    parser_apply.set_defaults(func=apply)
+
+    parser_bench = commands.add_parser('bench', help='time parsing, the randomizer and saving on synthetic classes '
+                                                     'and compare with the stored baseline')
+    parser_bench.add_argument('--only', help='comma separated benchmark names, all by default')
+    parser_bench.add_argument('--learners', type=int, help='learners per synthetic class, 500 by default')
+    parser_bench.add_argument('--repeat', type=int, help='runs of each benchmark, 5 by default')
+    parser_bench.add_argument('--tolerance', type=float,
+                              help='fail when a benchmark is slower than the baseline by more than this fraction, '
+                                   '0.5 by default')
+    parser_bench.add_argument('--baseline', help='the stored timings, resources/benchmark_baseline.json by default')
+    parser_bench.add_argument('--save-baseline', action='store_true', help='store these timings as the baseline')
+    parser_bench.set_defaults(func=bench)
+
+    parser_imports = commands.add_parser('imports', help='report how long importing the package takes and which '
+                                                         'modules the time goes to')
+    parser_imports.add_argument('--modules', help='comma separated modules, the package and its entry points by '
+                                                  'default')
+    parser_imports.add_argument('--top', type=int, default=5, help='list this many of the slowest modules')
+    parser_imports.add_argument('--repeat', type=int, default=3)
+    parser_imports.set_defaults(func=imports)
+
+    parser_batch = commands.add_parser('batch', help='apply a manifest of targets and offsets to many workbooks on '
+                                                     'a process pool, resuming where an earlier run stopped')
+    parser_batch.add_argument('workbooks', nargs='+', help='directories of .xlsx files or glob patterns')
+    parser_batch.add_argument('--manifest', help='csv with workbook, sheet, name, grade and offset columns')
+    parser_batch.add_argument('--offset', type=int, help='move the grade of learners without a target by this much')
+    parser_batch.add_argument('--keep-existing', action='store_true', help='only fill blank scores')
+    parser_batch.add_argument('--threshold', type=float, default=RANDOMIZER_THRESHOLD)
+    parser_batch.add_argument('--max-loop', type=int, default=RANDOMIZER_MAX_LOOP)
+    parser_batch.add_argument('--mode', choices=RANDOMIZER_MODES, default=RANDOMIZER_MODE)
+    parser_batch.add_argument('--seed', type=int)
+    parser_batch.add_argument('--jobs', type=int, help='workbooks processed at once, one per CPU by default')
+    parser_batch.add_argument('--output-dir', help='save the workbooks here instead of overwriting them')
+    parser_batch.add_argument('--summary', help='JSON lines summary of each file, also used to resume (default {} '
+                                                'next to the output)'.format('classgenie-batch.jsonl'))
+    parser_batch.add_argument('--restart', action='store_true', help='process every file again, even the ones the '
+                                                                      'summary has as done')
+    parser_batch.add_argument('--dry-run', action='store_true', help='report without saving')
+    parser_batch.add_argument('--no-cache', action='store_true', help='parse every sheet instead of loading sheets '
+                                                                       'parsed before from the cache')
+    parser_batch.set_defaults(func=batch)
+
+    parser_export = commands.add_parser('export', help='write the component percentages and averages of every learner '
+                                                       'to CSV, JSON Lines or Parquet')
+    parser_export.add_argument('workbooks', nargs='+', help='.xlsx files, directories of them or glob patterns')
+    parser_export.add_argument('--output', required=True, help='.csv, .jsonl or .parquet (needs pyarrow) file')
+    parser_export.add_argument('--format', choices=('csv', 'jsonl', 'parquet'), help='instead of the output '
+                                                                                      'extension')
+    parser_export.add_argument('--sheets', help='comma separated sheet names, all sheets by default')
+    parser_export.add_argument('--components', type=int, default=3, help='component columns of each row')
+    parser_export.add_argument('--jobs', type=int, default=1,
+                               help='workbooks parsed at once in worker processes, by default one thread parses while '
+                                    'rows are written')
+    parser_export.add_argument('--stats-log', help='append the export time as a JSON line to this file')
+    parser_export.set_defaults(func=export)
+
+    parser_serve = commands.add_parser('serve', help='keep workbooks open and parsed in a local HTTP/JSON service')
+    parser_serve.add_argument('--host', default='127.0.0.1')
+    parser_serve.add_argument('--port', type=int, default=8765)
+    parser_serve.add_argument('--workers', type=int, help='randomizer processes, one per CPU by default')
+    parser_serve.add_argument('--no-cache', action='store_true', help='parse every sheet instead of loading sheets '
+                                                                       'parsed before from the cache')
+    parser_serve.set_defaults(func=serve)
+
+    return parser
+
+
+def main(argv: list[str] = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
@@ -0,0 +1,218 @@
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from class_record import Component
+from class_record import StudentRecord
+from class_record import TRANSMUTATION_TABLE
+
+if TYPE_CHECKING:
+    from class_record.journal import EditJournal
+
+
+def _split(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    scaled = 134217729.0 * values  # 2 ** 27 + 1
+    high = scaled - (scaled - values)
+    return high, values - high
+
+
+def py_round(values, ndigits=2) -> np.ndarray:
+    # round() rounds the exact value of the float while np.round rounds the already rounded scaled value,
+    # so the exact error of the scaling product is kept (Dekker's two-product) to break near ties like round()
+    values = np.asarray(values, dtype=float)
+    scale = 10.0 ** ndigits
+    product = values * scale
+    values_high, values_low = _split(values)
+    scale_high, scale_low = _split(np.float64(scale))
+    error = ((values_high * scale_high - product) + values_high * scale_low + values_low * scale_high) + \
+        values_low * scale_low
+
+    floor = np.floor(product)
+    distance = (product - (floor + 0.5)) + error
+    up = (distance > 0) | ((distance == 0) & (np.fmod(floor, 2) != 0))
+
+    return (floor + up) / scale
+
+
+def sum_columns(values: np.ndarray) -> np.ndarray:
+    # left to right like sum() over a learner's components, so the floats match StudentRecord.initial_average
+    total = np.zeros(values.shape[0])
+    for col in range(values.shape[1]):
+        total = total + values[:, col]
+
+    return total
+
+
+def _to_row(scores: list) -> list:
+    return [np.nan if score is None else score for score in scores]
+
+
+def _to_scores(row: np.ndarray) -> list:
+    return [None if value != value else (int(value) if value.is_integer() else value) for value in row.tolist()]
+
+
+class ComponentRow(Component):
+    # one learner's scores of a component, read from and written to the class matrix
+    __slots__ = ('_record', '_component', '_row')
+
+    def __init__(self, record: 'ClassRecord', component: int, row: int):
+        self._record = record
+        self._component = component
+        self._row = row
+        self._version = 0
+        self._total = None
+        self._weighted_average = None
+        self.label = record.labels[component]
+
+    @property
+    def scores(self) -> list:
+        return _to_scores(self._record.scores[self._component][self._row])
+
+    @scores.setter
+    def scores(self, scores: list):
+        self._log_edit()
+        self._record.scores[self._component][self._row] = _to_row(scores)
+        self._changed()
+
+    def _changed(self):
+        # other views of the row cache averages too, the record's generation makes all of them stale
+        super()._changed()
+        self._record.generation += 1
+
+    @property
+    def highest_total_score(self):
+        return self._record.highest_totals[self._component].item()
+
+    @property
+    def weight(self) -> float:
+        return self._record.weights[self._component].item()
+
+    @property
+    def version(self) -> tuple[int, int]:
+        return self._record.generation, self._version
+
+    def _sum_scores(self):
+        return np.nansum(self._record.scores[self._component][self._row]).item()
+
+    def weighted_average(self):
+        return round(self.percentage_score() * self.weight, 2)
+
+    @property
+    def modified(self) -> bool:
+        current = self._record.scores[self._component][self._row]
+        saved = self._record.saved_scores[self._component][self._row]
+        return not np.array_equal(current, saved, equal_nan=True)
+
+    def snapshot(self) -> tuple:
+        # a copy of the matrix row in the shape of a packed list, blanks are None and the mask is empty
+        return _to_scores(self._record.scores[self._component][self._row]), 0
+
+    def restore(self, snapshot: tuple):
+        self._log_edit()
+        self._record.scores[self._component][self._row] = _to_row(snapshot[0])
+        self._changed()
+
+    def _log_edit(self):
+        # views are made on every read, the journal keys the edit by the matrix row it changes
+        edits = self._record._edits
+        key = (self._component, self._row)
+        if edits is not None and key not in edits:
+            edits[key] = (self, self.snapshot())
+
+    def mark_saved(self):
+        self._record.saved_scores[self._component][self._row] = self._record.scores[self._component][self._row]
+
+
+class ClassRecord:
+    # a class as one learners x items matrix per component, StudentRecords are views over a row
+
+    def __init__(self, head_components: list[Component], names: list = None):
+        names = list(names) if names is not None else []
+
+        self.head_components = head_components
+        self.labels = [head.label for head in head_components]
+        self.weights = np.array([head.weight for head in head_components], dtype=float)
+        self.highest_scores = [np.array(head.scores, dtype=float) for head in head_components]
+        self.highest_totals = np.array([head.highest_total_score for head in head_components], dtype=float)
+
+        self.names = names
+        self.scores = [np.full((len(names), len(head.scores)), np.nan) for head in head_components]
+        self.saved_scores = [matrix.copy() for matrix in self.scores]
+
+        # bumped on every change made through the matrices, views compare it to know their averages are stale
+        self.generation = 0
+        self._journal = None
+        # {(component, row): (view, snapshot)} of the open journal transaction, see class_record.journal
+        self._edits = None
+
+    @classmethod
+    def from_student_records(cls, head_components: list[Component],
+                             student_records: list[StudentRecord]) -> 'ClassRecord':
+        record = cls(head_components, [sr.name for sr in student_records])
+        for row, sr in enumerate(student_records):
+            for matrix, component in zip(record.scores, sr.components):
+                matrix[row, :len(component.scores)] = _to_row(component.scores)
+        record.saved_scores = [matrix.copy() for matrix in record.scores]
+
+        return record
+
+    @classmethod
+    def from_class_sheet(cls, cs) -> 'ClassRecord':
+        return cls.from_student_records(cs.head_components, cs.student_records)
+
+    @property
+    def journal(self) -> 'EditJournal':
+        # undo and redo of the edits made through the views, see class_record.journal
+        if self._journal is None:
+            from class_record.journal import EditJournal
+            self._journal = EditJournal(self)
+
+        return self._journal
+
+    def set_scores(self, component: int, rows, values):
+        self.scores[component][rows] = values
+        self.generation += 1
+
+    def totals(self) -> np.ndarray:
+        return np.column_stack([np.nansum(matrix, axis=1) for matrix in self.scores]) if self.scores else \
+            np.zeros((len(self.names), 0))
+
+    def percentage_scores(self) -> np.ndarray:
+        return py_round(self.totals() / self.highest_totals * 100)
+
+    def weighted_averages(self) -> np.ndarray:
+        return py_round(self.percentage_scores() * self.weights)
+
+    def initial_averages(self) -> np.ndarray:
+        return sum_columns(self.weighted_averages())
+
+    def transmuted_averages(self, default=0) -> np.ndarray:
+        return TRANSMUTATION_TABLE.transmute_many(self.initial_averages(), default)
+
+    def student_record(self, row: int) -> StudentRecord:
+        return StudentRecord(name=self.names[row],
+                             components=[ComponentRow(self, component, row) for component in range(len(self.scores))])
+
+    @property
+    def student_records(self) -> list[StudentRecord]:
+        return [self.student_record(row) for row in range(len(self))]
+
+    def update_student_records(self, student_records: list[StudentRecord]):
+        # copies changed rows back into (for instance) ClassSheet.student_records before saving
+        for row, sr in enumerate(student_records):
+            for matrix, component in zip(self.scores, sr.components):
+                scores = _to_scores(matrix[row])
+                if scores != component.scores:
+                    component.scores = scores
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, row: int) -> StudentRecord:
+        return self.student_record(row)
+
+    def __iter__(self):
+        return (self.student_record(row) for row in range(len(self)))
+
+    def __repr__(self):
+        return "<ClassRecord(learners='{}', components='{}')>".format(len(self), self.labels)
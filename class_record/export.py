@@ -0,0 +1,241 @@
+import csv
+import json
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+from class_record import StudentRecord
+from class_record.stats import RunStats
+from class_record.streaming import iter_class_records
+from class_record.xlsx import XlsxWorkbook
+
+EXPORT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.parquet': 'parquet'}
+# the DepEd template has written works, performance tasks and quarterly assessment, rows have a fixed number of
+# component columns so every sheet fits the same schema
+EXPORT_COMPONENTS = 3
+# rows buffered before a Parquet row group is written, the whole export never holds more than this
+ROW_GROUP_SIZE = 10_000
+# rows parsed ahead of the writer when parsing on a thread
+QUEUE_SIZE = 1_000
+
+
+def export_columns(components=EXPORT_COMPONENTS) -> list[str]:
+    columns = ['workbook', 'sheet', 'number', 'name']
+    for idx in range(1, components + 1):
+        columns.extend(['component{}'.format(idx), 'component{}_percentage'.format(idx),
+                        'component{}_weighted'.format(idx)])
+    columns.extend(['initial_average', 'transmuted_average'])
+
+    return columns
+
+
+def record_row(workbook: str, sheet: str, number: int, sr: StudentRecord, components=EXPORT_COMPONENTS) -> tuple:
+    if len(sr.components) > components:
+        raise ValueError('{} of {} has {} components, the export has room for {}'.format(
+            sheet, workbook, len(sr.components), components))
+
+    row = [workbook, sheet, number, None if sr.name is None else str(sr.name)]
+    for component in sr.components:
+        row.extend([component.label, component.percentage_score(), component.weighted_average()])
+    row.extend([None] * 3 * (components - len(sr.components)))
+    row.extend([sr.initial_average, sr.transmuted_average])
+
+    return tuple(row)
+
+
+def iter_workbook_rows(path: str, sheet_names: list[str] = None, components=EXPORT_COMPONENTS) -> Iterator[tuple]:
+    # the rows of every learner of a workbook, read in one pass over each sheet without keeping the sheet in memory
+    workbook = os.path.basename(path)
+    book = XlsxWorkbook(path)
+    if sheet_names is not None:
+        sheet_names = [name for name in sheet_names if name in book.sheet_names]
+
+    number, last = 0, None
+    for sheet, sr in iter_class_records(book, sheet_names):
+        number = number + 1 if sheet == last else 1
+        last = sheet
+        yield record_row(workbook, sheet, number, sr, components)
+
+
+def _workbook_rows(path: str, sheet_names: list[str], components: int) -> list[tuple]:
+    return list(iter_workbook_rows(path, sheet_names, components))
+
+
+def _threaded_rows(paths: list[str], sheet_names: list[str], components: int, on_error=None) -> Iterator[tuple]:
+    # parses on a thread while the caller writes, at most QUEUE_SIZE rows wait in between. a workbook is parsed whole
+    # before its rows are queued, so one failing part way is skipped completely like with the process pool
+    rows = queue.Queue(maxsize=QUEUE_SIZE)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                rows.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def parse():
+        for path in paths:
+            try:
+                workbook_rows = _workbook_rows(path, sheet_names, components)
+            except Exception as e:
+                put((path, e))
+                continue
+            for row in workbook_rows:
+                if stop.is_set():
+                    return
+                put(row)
+        put(done)
+
+    thread = threading.Thread(target=parse, name='classgenie-export', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = rows.get()
+            if item is done:
+                return
+            if isinstance(item[1], Exception):
+                if on_error is None:
+                    raise item[1]
+                on_error(*item)
+                continue
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _pooled_rows(paths: list[str], sheet_names: list[str], components: int, jobs: int,
+                 on_error=None) -> Iterator[tuple]:
+    # one workbook per job, at most two per worker are parsed ahead and the rows come out in the order of paths
+    window = jobs * 2
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = []
+        paths = iter(paths)
+        try:
+            while True:
+                for path in paths:
+                    pending.append((path, executor.submit(_workbook_rows, path, sheet_names, components)))
+                    if len(pending) >= window:
+                        break
+                if not pending:
+                    return
+                path, future = pending.pop(0)
+                try:
+                    rows = future.result()
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    on_error(path, e)
+                    continue
+                yield from rows
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def iter_rows(paths: list[str], sheet_names: list[str] = None, components=EXPORT_COMPONENTS, jobs=1,
+              on_error=None) -> Iterator[tuple]:
+    # the rows of every workbook in order, on_error(path, error) is called for a workbook that cannot be read and the
+    # others are still exported, without it the error is raised
+    if jobs > 1 and len(paths) > 1:
+        return _pooled_rows(paths, sheet_names, components, jobs, on_error)
+
+    return _threaded_rows(paths, sheet_names, components, on_error)
+
+
+class CsvExport:
+    def __init__(self, path: str, columns: list[str]):
+        self._file = open(path, 'w', newline='', encoding='utf-8')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write(self, row: tuple):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+
+class JsonLinesExport:
+    def __init__(self, path: str, columns: list[str]):
+        self._file = open(path, 'w', encoding='utf-8')
+        self._columns = columns
+
+    def write(self, row: tuple):
+        self._file.write(json.dumps(dict(zip(self._columns, row)), separators=(',', ':')) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetExport:
+    # needs pyarrow, rows are written in row groups of ROW_GROUP_SIZE
+    def __init__(self, path: str, columns: list[str], row_group_size=ROW_GROUP_SIZE):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError('Exporting to Parquet needs pyarrow (pip install pyarrow)') from e
+
+        self._pa = pa
+        fields = []
+        for column in columns:
+            if column in ('number', 'transmuted_average'):
+                fields.append(pa.field(column, pa.int64()))
+            elif column.endswith(('_percentage', '_weighted', '_average')):
+                fields.append(pa.field(column, pa.float64()))
+            else:
+                fields.append(pa.field(column, pa.string()))
+        self._schema = pa.schema(fields)
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._row_group_size = row_group_size
+        self._rows = []
+
+    def write(self, row: tuple):
+        self._rows.append(row)
+        if len(self._rows) >= self._row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            columns = [list(column) for column in zip(*self._rows)]
+            self._writer.write_table(self._pa.Table.from_arrays(
+                [self._pa.array(values, type=field.type) for values, field in zip(columns, self._schema)],
+                schema=self._schema))
+            self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+EXPORTS = {'csv': CsvExport, 'jsonl': JsonLinesExport, 'parquet': ParquetExport}
+
+
+def export_format(path: str) -> str:
+    fmt = EXPORT_FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        raise ValueError('Unknown export format of {}, use one of {}'.format(path, ', '.join(EXPORT_FORMATS)))
+    return fmt
+
+
+def export(paths: list[str], output: str, fmt: str = None, sheet_names: list[str] = None,
+           components=EXPORT_COMPONENTS, jobs=1, stats: RunStats = None, on_error=None) -> int:
+    # writes a row per learner of every sheet of the workbooks to output while they are parsed
+    # returns the number of rows, the export is timed in stats when given
+    exporter = EXPORTS[fmt or export_format(output)](output, export_columns(components))
+    count = 0
+    try:
+        with (stats or RunStats('export')).phase('export'):
+            for row in iter_rows(paths, sheet_names, components, jobs, on_error):
+                exporter.write(row)
+                count += 1
+    finally:
+        exporter.close()
+
+    return count
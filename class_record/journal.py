@@ -0,0 +1,156 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+from typing import Union
+
+from class_record import ClassSheet
+from class_record import Component
+
+if TYPE_CHECKING:
+    from class_record.engine import ClassRecord
+
+# transactions kept for undo, the oldest is dropped past this
+JOURNAL_LIMIT = 20
+
+# a component a transaction changed, old and new are Component.snapshot() tokens. the tokens share the packed scores
+# the component held (a ClassRecord view copies its matrix row), untouched components are not recorded at all
+Edit = namedtuple('Edit', ['component', 'old', 'new'])
+
+
+class Transaction:
+    # the edits of one operation, e.g. a class generation
+    def __init__(self, label: str, edits: list[Edit]):
+        self.label = label
+        self.edits = edits
+
+    @property
+    def cells(self) -> int:
+        # the scores that differ, for reporting; only the recorded components are looked at
+        count = 0
+        for edit in self.edits:
+            old_values, old_mask = edit.old
+            new_values, new_mask = edit.new
+            for idx, (old, new) in enumerate(zip(old_values, new_values)):
+                if old != new or (old_mask >> idx & 1) != (new_mask >> idx & 1):
+                    count += 1
+        return count
+
+    def apply(self, undo=False):
+        # puts the components back to the old (undo) or new (redo) scores
+        for edit in reversed(self.edits) if undo else self.edits:
+            edit.component.restore(edit.old if undo else edit.new)
+
+    def __len__(self):
+        return len(self.edits)
+
+    def __repr__(self):
+        return "<Transaction(label='{}', edits='{}')>".format(self.label, len(self.edits))
+
+
+class EditJournal:
+    # undo/redo of the learners' scores of a ClassSheet or a ClassRecord. while a transaction is open, a component
+    # reports its scores to the owner before its first change (see Component._log_edit), so commit() and rollback()
+    # only look at the components that were written. undo() and redo() restore just those, save_sheet then writes
+    # just those cells since the others are not modified, so nothing is read from the workbook again
+    def __init__(self, cs: Union[ClassSheet, 'ClassRecord'], limit=JOURNAL_LIMIT):
+        self._cs = cs
+        self.limit = limit
+        self._undo = []
+        self._redo = []
+        self._label = None
+
+    @property
+    def active(self) -> bool:
+        return self._cs._edits is not None
+
+    def begin(self, label: str = None):
+        if self.active:
+            raise RuntimeError('A {!r} transaction is already open.'.format(self._label))
+
+        self._label = label
+        self._cs._edits = {}
+
+    def _close(self) -> list[tuple[Component, tuple]]:
+        if not self.active:
+            raise RuntimeError('No transaction is open.')
+
+        written, self._cs._edits = list(self._cs._edits.values()), None
+        return written
+
+    def commit(self) -> Transaction:
+        # returns the transaction, None when the components written hold the scores they started with
+        edits = []
+        for component, old in self._close():
+            new = component.snapshot()
+            if new != old:
+                edits.append(Edit(component, old, new))
+
+        transaction = Transaction(self._label, edits) if edits else None
+        if transaction is not None:
+            self._undo.append(transaction)
+            del self._undo[:-self.limit]
+            self._redo.clear()
+
+        return transaction
+
+    def rollback(self) -> int:
+        # restores the components written since begin(), returns how many
+        written = self._close()
+        for component, old in reversed(written):
+            component.restore(old)
+
+        return len(written)
+
+    @contextmanager
+    def transaction(self, label: str = None):
+        # commits on success, rolls back when the block raises
+        self.begin(label)
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._undo)
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._redo)
+
+    def undo(self) -> Transaction:
+        # returns the transaction undone, None when there is nothing to undo
+        if self.active:
+            raise RuntimeError('Commit or roll back the {!r} transaction first.'.format(self._label))
+        if not self._undo:
+            return None
+
+        transaction = self._undo.pop()
+        transaction.apply(undo=True)
+        self._redo.append(transaction)
+
+        return transaction
+
+    def redo(self) -> Transaction:
+        if self.active:
+            raise RuntimeError('Commit or roll back the {!r} transaction first.'.format(self._label))
+        if not self._redo:
+            return None
+
+        transaction = self._redo.pop()
+        transaction.apply()
+        self._undo.append(transaction)
+
+        return transaction
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+
+    def __len__(self):
+        return len(self._undo)
+
+    def __repr__(self):
+        return "<EditJournal(undo='{}', redo='{}')>".format(len(self._undo), len(self._redo))
@@ -0,0 +1,207 @@
+import math
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from contextlib import nullcontext
+from multiprocessing.shared_memory import SharedMemory
+from typing import Union
+
+import numpy as np
+
+from class_record import ClassSheet
+from class_record import Component
+from class_record import StudentRecord
+from class_record.randomizer import MaximumLoopReached
+from class_record.randomizer import SolutionPool
+from class_record.randomizer import randomize_student_record
+from class_record.stats import RunStats
+
+CHUNKS_PER_WORKER = 4
+
+
+def score_layout(head_components: list[Component]) -> list[tuple[list, float, float]]:
+    # (highest item scores, highest total score, weight) of each component, in matrix column order
+    return [(list(head.scores), head.highest_total_score, head.weight) for head in head_components]
+
+
+def score_matrix(student_records: list[StudentRecord], layout: list[tuple], out: np.ndarray = None) -> np.ndarray:
+    # learners x items, blank scores are NaN
+    width = sum(len(highest) for highest, _, _ in layout)
+    matrix = out if out is not None else np.empty((len(student_records), width))
+    for row, record in enumerate(student_records):
+        matrix[row] = [np.nan if score is None else score
+                       for component in record.components for score in component.scores]
+
+    return matrix
+
+
+def _scores(values) -> list:
+    return [None if math.isnan(value) else (int(value) if value.is_integer() else value) for value in values]
+
+
+def record_from_row(row: np.ndarray, layout: list[tuple]) -> StudentRecord:
+    components = []
+    start = 0
+    for highest, highest_total_score, weight in layout:
+        components.append(
+            Component(scores=_scores(row[start:start + len(highest)].tolist()), weight=weight,
+                      highest_total_score=highest_total_score)
+        )
+        start += len(highest)
+
+    return StudentRecord(components=components)
+
+
+class Cancelled(Exception):
+    pass
+
+
+def _randomize_rows(matrix: np.ndarray, layout: list[tuple], jobs: list[tuple], options: dict,
+                    progress=None, cancelled=None, pool: SolutionPool = None) -> tuple[list[tuple], RunStats]:
+    # returns (row, new transmuted average, error) of every job and the randomizer stats of the jobs
+    head_components = [Component(scores=highest, weight=weight, highest_total_score=highest_total_score)
+                       for highest, highest_total_score, weight in layout]
+    stats = RunStats('randomize')
+    results = []
+    for row, expected_average, seed in jobs:
+        if cancelled is not None and cancelled():
+            raise Cancelled()
+
+        record = record_from_row(matrix[row], layout)
+        try:
+            randomize_student_record(record, expected_average, head_components, rng=random.Random(seed), stats=stats,
+                                     pool=pool, **options)
+        except MaximumLoopReached as e:
+            result = (row, record.transmuted_average, str(e))
+        else:
+            matrix[row] = [np.nan if score is None else score
+                           for component in record.components for score in component.scores]
+            result = (row, record.transmuted_average, None)
+
+        results.append(result)
+        if progress is not None:
+            progress(*result)
+
+    # only the counts, randomize_class times the jobs as a whole
+    stats.phases.clear()
+    return results, stats
+
+
+def _randomize_shared_rows(name: str, shape: tuple, layout: list[tuple], jobs: list[tuple], options: dict,
+                           pool: SolutionPool = None) -> tuple[list[tuple], RunStats, list]:
+    # runs in a worker process, the rows are filled in place in the parent's shared matrix; the worker gets a copy of
+    # the pool and hands back the solutions it added
+    shm = SharedMemory(name=name)
+    try:
+        results, stats = _randomize_rows(np.ndarray(shape, dtype=np.float64, buffer=shm.buf), layout, jobs, options,
+                                         pool=pool)
+        return results, stats, pool.take_added() if pool is not None else []
+    finally:
+        shm.close()
+
+
+def randomize_class(sheet: ClassSheet, targets: Union[dict, list], workers: int = None, seed=None, max_loop=500,
+                    threshold=1.5, overwrite_all=True, average_limit=100, mode='direct', progress=None,
+                    cancelled=None, stats: RunStats = None, pool: SolutionPool = None,
+                    executor: ProcessPoolExecutor = None) -> dict[int, str]:
+    # targets maps learner index to expected average (or lists them in order, None skips a learner)
+    # progress(learner index, new transmuted average, error) is called as each learner finishes, and the run stops
+    # with Cancelled as soon as cancelled() is true; the learners' scores are only updated once every job is done
+    # returns {learner index: error} of the learners left unchanged, the phase times and randomizer counts are added
+    # to stats when given (the randomize phase is the wall time of the whole pool)
+    # learners reuse the solutions in pool (see SolutionPool), which makes their scores depend on the learners solved
+    # before them in the same process; without a pool they only depend on the seed
+    # a long-running caller can pass its own executor, otherwise a process pool is started for each call
+    if not isinstance(targets, dict):
+        targets = {idx: target for idx, target in enumerate(targets) if target is not None}
+
+    run = RunStats('randomize_class')
+    records = sheet.student_records
+    layout = score_layout(sheet.head_components)
+    options = dict(max_loop=max_loop, threshold=threshold, overwrite_all=overwrite_all, average_limit=average_limit,
+                   mode=mode)
+
+    # one seed per learner, the results do not depend on how learners are spread over the workers
+    seeds = random.Random(seed)
+    jobs = [(idx, targets[idx], seeds.getrandbits(64)) for idx in sorted(targets)]
+
+    workers = workers if workers is not None else os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    shape = (len(records), sum(len(highest) for highest, _, _ in layout))
+
+    try:
+        with run.phase('randomize'):
+            matrix, results = _run_jobs(records, layout, jobs, options, workers, shape, progress, cancelled, run,
+                                        pool, executor)
+
+        with run.phase('update'):
+            failures = _update_records(records, layout, jobs, matrix, results)
+    finally:
+        if stats is not None:
+            stats.merge(run)
+
+    return failures
+
+
+def _run_jobs(records: list[StudentRecord], layout: list[tuple], jobs: list[tuple], options: dict, workers: int,
+              shape: tuple, progress, cancelled, run: RunStats, pool: SolutionPool,
+              executor: ProcessPoolExecutor = None) -> tuple[np.ndarray, list[tuple]]:
+    if workers <= 1:
+        matrix = score_matrix(records, layout)
+        results, stats = _randomize_rows(matrix, layout, jobs, options, progress, cancelled, pool)
+        run.merge(stats)
+    else:
+        shm = SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+        shared = None
+        try:
+            shared = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+            score_matrix(records, layout, out=shared)
+
+            # single learner chunks when progress is reported, so it is reported per learner
+            size = 1 if progress is not None else math.ceil(len(jobs) / (workers * CHUNKS_PER_WORKER))
+            chunks = [jobs[start:start + size] for start in range(0, len(jobs), size)]
+            results = []
+            with ProcessPoolExecutor(max_workers=workers) if executor is None else nullcontext(executor) as executor:
+                futures = [executor.submit(_randomize_shared_rows, shm.name, shape, layout, chunk, options, pool)
+                           for chunk in chunks]
+                try:
+                    for future in as_completed(futures):
+                        if cancelled is not None and cancelled():
+                            raise Cancelled()
+                        chunk_results, stats, added = future.result()
+                        run.merge(stats)
+                        if pool is not None:
+                            pool.update(added)
+                        for result in chunk_results:
+                            results.append(result)
+                            if progress is not None:
+                                progress(*result)
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+            matrix = shared.copy()
+        finally:
+            del shared
+            shm.close()
+            shm.unlink()
+
+    return matrix, results
+
+
+def _update_records(records: list[StudentRecord], layout: list[tuple], jobs: list[tuple], matrix: np.ndarray,
+                    results: list[tuple]) -> dict[int, str]:
+    failures = {row: error for row, _, error in results if error is not None}
+    for idx, _, _ in jobs:
+        if idx in failures:
+            continue
+        start = 0
+        for component, (highest, _, _) in zip(records[idx].components, layout):
+            scores = _scores(matrix[idx, start:start + len(highest)].tolist())
+            if scores != component.scores:
+                component.scores = scores
+            start += len(highest)
+
+    return failures
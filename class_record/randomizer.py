@@ -1,6 +1,18 @@
 import random
+import sys
+from collections import OrderedDict
+from functools import lru_cache
 
-from class_record import StudentRecord, Component
+from class_record import Component
+from class_record import StudentRecord
+from class_record import TRANSMUTATION_TABLE
+from class_record.stats import RunStats
+
+DIRECT_MAX_ATTEMPTS = 200
+BATCH_SIZE = 4096
+REACHABLE_CACHE_SIZE = 1024
+POOL_MAX_BYTES = 4 * 1024 * 1024
+POOL_VARIANTS = 4
 
 
 class MaximumLoopReached(RuntimeError):
@@ -8,41 +20,467 @@ class MaximumLoopReached(RuntimeError):
         super().__init__(*args)
 
 
-def random_scores(highest_scores: list, threshold=1.0, existing_scores: list = None):
+class UnreachableGrade(MaximumLoopReached):
+    # raised before any loop when no scores within the bounds give the grade, nearest lists the closest grades that
+    # can be reached (one below and one above, when there are)
+    def __init__(self, expected_average, nearest: list):
+        self.expected_average = expected_average
+        self.nearest = nearest
+        if nearest:
+            message = '{} cannot be reached, the nearest reachable grade is {}.'.format(
+                expected_average, ' or '.join(str(grade) for grade in nearest))
+        else:
+            message = '{} cannot be reached.'.format(expected_average)
+        super().__init__(message)
+
+
+def _randomized(stats: RunStats, iterations: int, reached: bool):
+    if stats is not None:
+        stats.randomized(iterations, reached)
+
+
+def random_scores(highest_scores: list, threshold=1.0, existing_scores: list = None, rng: random.Random = random):
     if threshold > 2:
         raise ValueError('Threshold exceeded to 2.0, it should be in 1.0 - 2.0')
 
     if existing_scores is None:
-        return [random.randint(round(threshold * score) - score, score) for score in highest_scores]
+        return [rng.randint(round(threshold * score) - score, score) for score in highest_scores]
 
     if len(existing_scores) != len(highest_scores):
         raise ValueError('length of highest scores and existing scores is not equal.')
 
-    return [random.randint(round(threshold * highest) - highest, highest) if existing is None else existing
+    return [rng.randint(round(threshold * highest) - highest, highest) if existing is None else existing
             for highest, existing in zip(highest_scores, existing_scores)]
 
 
-def randomize_student_record(sr: StudentRecord, expected_average, highest_component: list[Component],
-                             max_loop=500, threshold=1.5, overwrite_all=True, average_limit=100):
-    old_scores = [component.scores for component in sr.components]
+def score_bounds(highest_scores: list, threshold=1.0, existing_scores: list = None) -> list[tuple]:
+    # (lowest, highest) score random_scores can give each item, kept scores are fixed
+    if threshold > 2:
+        raise ValueError('Threshold exceeded to 2.0, it should be in 1.0 - 2.0')
+
+    if existing_scores is None:
+        existing_scores = [None] * len(highest_scores)
+    elif len(existing_scores) != len(highest_scores):
+        raise ValueError('length of highest scores and existing scores is not equal.')
+
+    return [(round(threshold * highest) - highest, highest) if existing is None else (existing, existing)
+            for highest, existing in zip(highest_scores, existing_scores)]
+
+
+def weighted_average(total, highest_total_score, weight):
+    # same rounding as Component.weighted_average
+    return round(round((total / highest_total_score) * 100, 2) * weight, 2)
+
+
+def spread_scores(total: int, bounds: list[tuple], rng: random.Random = random) -> list:
+    # random scores within bounds whose free (not fixed) part sums up to total
+    scores = [low for low, high in bounds]
+    free = [idx for idx, (low, high) in enumerate(bounds) if low != high]
+    rng.shuffle(free)
+
+    remaining = total
+    capacity = sum(bounds[idx][1] - bounds[idx][0] for idx in free)
+    for idx in free:
+        low, high = bounds[idx]
+        capacity -= high - low
+        given = rng.randint(max(0, remaining - capacity), min(high - low, remaining))
+        scores[idx] += given
+        remaining -= given
+
+    return scores
+
+
+@lru_cache(maxsize=REACHABLE_CACHE_SIZE)
+def _component_cents(highest_total_score, weight, fixed, low: int, high: int) -> int:
+    # bitset of the weighted averages (in cents) of the component totals fixed + low .. fixed + high
+    bits = 0
+    for free in range(low, high + 1):
+        bits |= 1 << round(weighted_average(fixed + free, highest_total_score, weight) * 100)
+
+    return bits
+
+
+@lru_cache(maxsize=REACHABLE_CACHE_SIZE)
+def _reachable_grades(components: tuple) -> tuple:
+    # components are (highest total score, weight, kept total, free low, free high); the initial averages are the sums
+    # of one weighted average per component, so their set is built by shifting one component's bitset by another's
+    averages = 1
+    for component in components:
+        bits = _component_cents(*component)
+        total = 0
+        while bits:
+            lowest = bits & -bits
+            total |= averages << (lowest.bit_length() - 1)
+            bits ^= lowest
+        averages = total
+
+    grades = []
+    for grade in TRANSMUTATION_TABLE.grades:
+        interval = TRANSMUTATION_TABLE.interval(grade)
+        low, high = round(interval.min * 100), round(interval.max * 100)
+        if (averages >> low) & ((1 << (high - low + 1)) - 1):
+            grades.append(grade)
+
+    return tuple(grades)
+
+
+def reachable_grades(sr: StudentRecord, highest_component: list[Component], threshold=1.5,
+                     overwrite_all=True) -> tuple:
+    # the transmuted grades the randomizer can give the learner, computed on cent exact averages from the component
+    # total ranges and cached per head components, threshold and kept scores
+    existing_scores = [component.scores for component in sr.components] if overwrite_all is False else \
+        [None] * len(sr.components)
+
+    components = []
+    for component, highest, existing in zip(sr.components, highest_component, existing_scores):
+        bounds = score_bounds(highest.scores, threshold, existing)
+        fixed = sum(low for low, high in bounds if low == high and low is not None)
+        free_low = sum(int(low) for low, high in bounds if low != high)
+        free_high = sum(int(high) for low, high in bounds if low != high)
+        components.append((component.highest_total_score, component.weight, fixed, free_low, free_high))
+
+    return _reachable_grades(tuple(components))
+
+
+def nearest_grades(expected_average, grades) -> list:
+    below = [grade for grade in grades if grade < expected_average]
+    above = [grade for grade in grades if grade > expected_average]
+
+    return ([max(below)] if below else []) + ([min(above)] if above else [])
+
+
+def _first_total(weighted, start, end, minimum):
+    # smallest total in start..end whose weighted average is at least minimum, end + 1 if none
+    while start <= end:
+        mid = (start + end) // 2
+        if weighted(mid) >= minimum:
+            end = mid - 1
+        else:
+            start = mid + 1
+
+    return start
+
+
+def _last_total(weighted, start, end, maximum):
+    # largest total in start..end whose weighted average is at most maximum, start - 1 if none
+    while start <= end:
+        mid = (start + end) // 2
+        if weighted(mid) <= maximum:
+            start = mid + 1
+        else:
+            end = mid - 1
+
+    return end
+
+
+def construct_student_record(sr: StudentRecord, expected_average, highest_component: list[Component],
+                             max_attempts=DIRECT_MAX_ATTEMPTS, threshold=1.5, overwrite_all=True,
+                             rng: random.Random = random, stats: RunStats = None):
+    # picks component totals landing inside the initial average interval of the grade, then spreads them on items
+    if sr.transmuted_average == expected_average:
+        _randomized(stats, 0, True)
+        return
+
+    snapshots = [component.snapshot() for component in sr.components]
+    existing_scores = [component.scores for component in sr.components] if overwrite_all is False else \
+        [None] * len(sr.components)
+
+    interval = TRANSMUTATION_TABLE.interval(expected_average)
+    if interval is None:
+        _randomized(stats, 0, False)
+        raise MaximumLoopReached('{} is not a transmuted grade.'.format(expected_average))
+
+    bounds = [score_bounds(highest.scores, threshold, existing)
+              for highest, existing in zip(highest_component, existing_scores)]
+    weighted = []
+    free_ranges = []
+    for component, comp_bounds in zip(sr.components, bounds):
+        fixed = sum(low for low, high in comp_bounds if low == high and low is not None)
+        weighted.append(
+            lambda free, fixed=fixed, component=component: weighted_average(fixed + free,
+                                                                            component.highest_total_score,
+                                                                            component.weight)
+        )
+        free_ranges.append((sum(low for low, high in comp_bounds if low != high),
+                            sum(high for low, high in comp_bounds if low != high)))
+
+    epsilon = 1e-9
+    for attempt in range(1, max_attempts + 1):
+        order = list(range(len(sr.components)))
+        rng.shuffle(order)
+
+        rest_min = sum(weighted[idx](free_ranges[idx][0]) for idx in order)
+        rest_max = sum(weighted[idx](free_ranges[idx][1]) for idx in order)
+        partial = 0
+        totals = {}
+        for idx in order:
+            start, end = free_ranges[idx]
+            rest_min -= weighted[idx](start)
+            rest_max -= weighted[idx](end)
+
+            first = _first_total(weighted[idx], start, end, interval.min - partial - rest_max - epsilon)
+            last = _last_total(weighted[idx], start, end, interval.max - partial - rest_min + epsilon)
+            if first > last:
+                break
 
-    existing_scores = old_scores if overwrite_all is False else ([None] * len(old_scores))
+            totals[idx] = rng.randint(first, last)
+            partial += weighted[idx](totals[idx])
+        else:
+            for idx, component in enumerate(sr.components):
+                component.scores = spread_scores(totals[idx] - free_ranges[idx][0], bounds[idx], rng)
 
-    if sr.transmuted_average > average_limit:
+            if sr.transmuted_average == expected_average:
+                _randomized(stats, attempt, True)
+                return
+
+    for component, snapshot in zip(sr.components, snapshots):
+        component.restore(snapshot)
+
+    _randomized(stats, max_attempts, False)
+    raise MaximumLoopReached('Maximum loop reached.')
+
+
+def batch_student_record(sr: StudentRecord, expected_average, highest_component: list[Component], max_loop=500,
+                         threshold=1.5, overwrite_all=True, batch_size=BATCH_SIZE, rng: random.Random = random,
+                         stats: RunStats = None):
+    # draws candidates like random_scores does, batch_size at a time, and grades them as arrays
+    import numpy as np
+
+    from class_record.engine import py_round
+    from class_record.engine import sum_columns
+
+    if sr.transmuted_average == expected_average:
+        _randomized(stats, 0, True)
         return
 
+    snapshots = [component.snapshot() for component in sr.components]
+    existing_scores = [component.scores for component in sr.components] if overwrite_all is False else \
+        [None] * len(sr.components)
+
+    bounds = [score_bounds(highest.scores, threshold, existing)
+              for highest, existing in zip(highest_component, existing_scores)]
+    free = [(comp_idx, item_idx) for comp_idx, comp_bounds in enumerate(bounds)
+            for item_idx, (low, high) in enumerate(comp_bounds) if low != high]
+    lows = np.array([bounds[comp_idx][item_idx][0] for comp_idx, item_idx in free], dtype=np.int64)
+    highs = np.array([bounds[comp_idx][item_idx][1] for comp_idx, item_idx in free], dtype=np.int64)
+
+    # free item -> component membership, so a matrix product gives every candidate's component totals
+    membership = np.zeros((len(free), len(bounds)))
+    for col, (comp_idx, _) in enumerate(free):
+        membership[col, comp_idx] = 1
+    fixed = np.array([sum(low for low, high in comp_bounds if low == high and low is not None)
+                      for comp_bounds in bounds], dtype=float)
+    highest_totals = np.array([component.highest_total_score for component in sr.components], dtype=float)
+    weights = np.array([component.weight for component in sr.components], dtype=float)
+
+    # the same number of candidates the sampling loop would draw for max_loop
+    remaining = max_loop // max(len(sr.components), 1) + 1
+    generator = np.random.default_rng(rng.getrandbits(64))
+    drawn = 0
+    while remaining > 0:
+        size = min(batch_size, remaining)
+        remaining -= size
+
+        candidates = generator.integers(lows, highs + 1, size=(size, len(free)))
+        totals = fixed + candidates @ membership
+        percentages = py_round(totals / highest_totals * 100)
+        initial_averages = sum_columns(py_round(percentages * weights))
+        transmuted = TRANSMUTATION_TABLE.transmute_many(initial_averages)
+
+        for hit in np.flatnonzero(transmuted == expected_average):
+            scores = [[low for low, high in comp_bounds] for comp_bounds in bounds]
+            for (comp_idx, item_idx), score in zip(free, candidates[hit].tolist()):
+                scores[comp_idx][item_idx] = score
+            for component, comp_scores in zip(sr.components, scores):
+                component.scores = comp_scores
+
+            if sr.transmuted_average == expected_average:
+                _randomized(stats, drawn + hit.item() + 1, True)
+                return
+        drawn += size
+
+    for component, snapshot in zip(sr.components, snapshots):
+        component.restore(snapshot)
+
+    _randomized(stats, drawn, False)
+    raise MaximumLoopReached('Maximum loop reached.')
+
+
+class SolutionPool:
+    # component totals that gave a grade, keyed by the item bounds (the head components' highest scores, the
+    # threshold and the kept scores), highest total scores, weights and the grade. once a key holds `variants`
+    # solutions, a learner with that key gets one of them spread over the items anew instead of a new search; the
+    # grade only depends on the totals so any spread keeps it. the least recently used keys go once the pool is over
+    # max_bytes
+    def __init__(self, max_bytes=POOL_MAX_BYTES, variants=POOL_VARIANTS):
+        self.max_bytes = max_bytes
+        self.variants = variants
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> [size, [totals, ...]]
+        self._added = []
+
+    @staticmethod
+    def key(sr: StudentRecord, expected_average, highest_component: list[Component], threshold=1.5,
+            overwrite_all=True) -> tuple:
+        existing_scores = [component.scores for component in sr.components] if overwrite_all is False else \
+            [None] * len(sr.components)
+
+        return tuple((tuple(score_bounds(highest.scores, threshold, existing)), component.highest_total_score,
+                      component.weight)
+                     for component, highest, existing in zip(sr.components, highest_component, existing_scores)
+                     ), expected_average
+
+    def draw(self, key: tuple, rng: random.Random = random):
+        # the totals of one solution, or None while the key has fewer than `variants`
+        entry = self._entries.get(key)
+        if entry is None or len(entry[1]) < self.variants:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return rng.choice(entry[1])
+
+    def add(self, key: tuple, totals: tuple):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [_deep_size(key), []]
+            self.size += entry[0]
+        elif len(entry[1]) >= self.variants or totals in entry[1]:
+            return
+
+        entry[1].append(totals)
+        entry[0] += sys.getsizeof(totals)
+        self.size += sys.getsizeof(totals)
+        self._added.append((key, totals))
+        self._entries.move_to_end(key)
+
+        while self.size > self.max_bytes and len(self._entries) > 1:
+            _, (size, _) = self._entries.popitem(last=False)
+            self.size -= size
+
+    def take_added(self) -> list[tuple]:
+        # the solutions added since the last call, so a worker process can hand them back to the parent's pool
+        added, self._added = self._added, []
+        return added
+
+    def update(self, added: list[tuple]):
+        for key, totals in added:
+            self.add(key, totals)
+
+    def clear(self):
+        self._entries.clear()
+        self._added = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<SolutionPool(keys='{}', size='{}', hits='{}', misses='{}')>".format(len(self), self.size, self.hits,
+                                                                                  self.misses)
+
+
+def _deep_size(value) -> int:
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(_deep_size(item) for item in value)
+
+    return sys.getsizeof(value)
+
+
+def _free_totals(sr: StudentRecord, key: tuple) -> tuple:
+    # the part of each component total above the lowest scores of its free items
+    return tuple(sum(score - low for score, (low, high) in zip(component.scores, bounds) if low != high)
+                 for component, (bounds, _, _) in zip(sr.components, key[0]))
+
+
+def _spread_totals(sr: StudentRecord, key: tuple, totals: tuple, rng: random.Random = random):
+    for component, (bounds, _, _), total in zip(sr.components, key[0], totals):
+        component.scores = spread_scores(total, list(bounds), rng)
+
+
+def randomize_student_record(sr: StudentRecord, expected_average, highest_component: list[Component],
+                             max_loop=500, threshold=1.5, overwrite_all=True, average_limit=100, mode='sample',
+                             rng: random.Random = random, stats: RunStats = None,
+                             pool: SolutionPool = None) -> RunStats:
+    # returns the iterations and wall time of this learner, also added to stats when given
+    # with a pool, learners whose bounds and target were solved before reuse those component totals
+    if mode not in ('sample', 'direct', 'batch'):
+        raise ValueError("Unknown mode '{}', it should be 'sample', 'direct' or 'batch'".format(mode))
+
+    call = RunStats('randomize')
+    try:
+        with call.phase('randomize'):
+            if sr.transmuted_average > average_limit:
+                pass
+            elif sr.transmuted_average != expected_average and \
+                    expected_average not in reachable_grades(sr, highest_component, threshold, overwrite_all):
+                call.randomized(0, False)
+                raise UnreachableGrade(expected_average, nearest_grades(
+                    expected_average, reachable_grades(sr, highest_component, threshold, overwrite_all)))
+            elif pool is not None and sr.transmuted_average != expected_average:
+                key = pool.key(sr, expected_average, highest_component, threshold, overwrite_all)
+                totals = pool.draw(key, rng)
+                if totals is not None:
+                    snapshots = [component.snapshot() for component in sr.components]
+                    _spread_totals(sr, key, totals, rng)
+                    if sr.transmuted_average == expected_average:
+                        call.randomized(1, True)
+                        call.pool_hits += 1
+                        return call
+                    for component, snapshot in zip(sr.components, snapshots):
+                        component.restore(snapshot)
+
+                _search(sr, expected_average, highest_component, max_loop, threshold, overwrite_all, mode, rng, call)
+                pool.add(key, _free_totals(sr, key))
+            else:
+                _search(sr, expected_average, highest_component, max_loop, threshold, overwrite_all, mode, rng, call)
+    finally:
+        if stats is not None:
+            stats.merge(call)
+
+    return call
+
+
+def _search(sr: StudentRecord, expected_average, highest_component: list[Component], max_loop, threshold,
+            overwrite_all, mode, rng: random.Random, stats: RunStats):
+    if mode == 'direct':
+        construct_student_record(sr, expected_average, highest_component, threshold=threshold,
+                                 overwrite_all=overwrite_all, rng=rng, stats=stats)
+    elif mode == 'batch':
+        batch_student_record(sr, expected_average, highest_component, max_loop=max_loop, threshold=threshold,
+                             overwrite_all=overwrite_all, rng=rng, stats=stats)
+    else:
+        sample_student_record(sr, expected_average, highest_component, max_loop=max_loop, threshold=threshold,
+                              overwrite_all=overwrite_all, rng=rng, stats=stats)
+
+
+def sample_student_record(sr: StudentRecord, expected_average, highest_component: list[Component], max_loop=500,
+                          threshold=1.5, overwrite_all=True, rng: random.Random = random, stats: RunStats = None):
+    # the original loop, every component is drawn again until the learner lands on the grade
+    snapshots = [component.snapshot() for component in sr.components]
+    existing_scores = [component.scores for component in sr.components] if overwrite_all is False else \
+        [None] * len(sr.components)
+
     loop_count = 0
+    draws = 0
     while sr.transmuted_average != expected_average and loop_count <= max_loop:
+        draws += 1
 
         for idx, component in enumerate(sr.components):
             component.scores = random_scores(highest_component[idx].scores, threshold,
-                                             existing_scores=existing_scores[idx])
+                                             existing_scores=existing_scores[idx], rng=rng)
 
             loop_count += 1
 
     if loop_count > max_loop:
 
-        for idx, component in enumerate(sr.components):
-            component.scores = old_scores[idx]
+        for component, snapshot in zip(sr.components, snapshots):
+            component.restore(snapshot)
 
+        _randomized(stats, draws, False)
         raise MaximumLoopReached('Maximum loop reached.')
+
+    _randomized(stats, draws, True)
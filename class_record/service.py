@@ -0,0 +1,329 @@
+import asyncio
+import json
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http import HTTPStatus
+from urllib.parse import unquote
+
+from class_record.cache import ParseCache
+from class_record.cli import RANDOMIZER_MAX_LOOP
+from class_record.cli import RANDOMIZER_MODE
+from class_record.cli import RANDOMIZER_MODES
+from class_record.cli import RANDOMIZER_THRESHOLD
+from class_record.cli import apply_targets
+from class_record.randomizer import SolutionPool
+from class_record.stats import RunStats
+from class_record.workbook import ClassWorkbook
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+# parsing, randomizing and saving run on these threads so the event loop keeps answering other sessions
+SERVICE_THREADS = 4
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+
+class ServiceError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Session:
+    # one open workbook with its parsed sheets, every request on it runs under its lock so edits, writes and saves
+    # of the same workbook never interleave
+    def __init__(self, book: ClassWorkbook):
+        self.id = uuid.uuid4().hex[:12]
+        self.book = book
+        self.pool = SolutionPool()
+        self.lock = asyncio.Lock()
+
+    def as_dict(self) -> dict:
+        return dict(session=self.id, path=self.book.path, sheets=self.book.sheet_names,
+                    loaded=[name for name in self.book.sheet_names if self.book.is_loaded(name)], pool=len(self.pool))
+
+    def __repr__(self):
+        return "<Session(id='{}', path='{}')>".format(self.id, self.book.path)
+
+
+class GradingService:
+    # keeps workbooks and their parsed sheets in memory between requests. the routes take and return JSON:
+    #   GET    /sessions                              open sessions
+    #   POST   /sessions                              {"path": ..., "sheets": [...]} opens (or finds) a workbook and
+    #                                                 parses the given sheets ahead
+    #   GET    /sessions/<id>                         the session
+    #   DELETE /sessions/<id>                         closes the workbook
+    #   GET    /sessions/<id>/sheets/<sheet>          the learners with their current averages
+    #   POST   /sessions/<id>/apply                   {"sheets": {sheet: {"targets": {learner: grade}, "offset": n}},
+    #                                                 "options": {...}, "save": true, "output": path}
+    #   POST   /sessions/<id>/save                    {"output": path}
+    # learners are randomized on a process pool shared by every session when workers is above 1
+    def __init__(self, workers: int = None, cache=True, threads=SERVICE_THREADS):
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.cache = ParseCache() if cache else None
+        self.sessions = {}
+        self.stats = RunStats('service')
+        self._threads = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='classgenie')
+        self._processes = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self._opening = asyncio.Lock()
+
+    async def _run(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._threads, partial(fn, *args, **kwargs))
+
+    def add(self, book: ClassWorkbook) -> Session:
+        session = Session(book)
+        self.sessions[session.id] = session
+        return session
+
+    def session(self, session_id: str) -> Session:
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise ServiceError(HTTPStatus.NOT_FOUND, 'No session {!r}'.format(session_id))
+        return session
+
+    async def open(self, path: str, sheets: list[str] = ()) -> Session:
+        # a workbook opened twice is the same session, so its writes stay serialized. the lookup and the opening run
+        # under one lock, otherwise two requests for the same path could both open it while the other one waits
+        if not os.path.isfile(path):
+            raise ServiceError(HTTPStatus.NOT_FOUND, 'No workbook at {!r}'.format(path))
+        async with self._opening:
+            for session in self.sessions.values():
+                if os.path.isfile(session.book.path) and os.path.samefile(session.book.path, path):
+                    break
+            else:
+                session = self.add(await self._run(ClassWorkbook, path, cache=self.cache))
+
+        async with session.lock:
+            for name in sheets:
+                await self._run(self._class_sheet, session, name)
+
+        return session
+
+    async def close(self, session_id: str):
+        session = self.session(session_id)
+        async with session.lock:
+            await self._run(session.book.close)
+        self.sessions.pop(session_id, None)
+
+    @staticmethod
+    def _class_sheet(session: Session, name: str):
+        if name not in session.book.sheet_names:
+            raise ServiceError(HTTPStatus.NOT_FOUND, 'No sheet {!r} in {}'.format(name, session.book.path))
+        # parsed here, on a service thread
+        cs = session.book.class_sheet(name)
+        cs.student_records
+        return cs
+
+    async def learners(self, session_id: str, name: str) -> dict:
+        session = self.session(session_id)
+        async with session.lock:
+            cs = await self._run(self._class_sheet, session, name)
+            return dict(sheet=name, learners=[dict(index=idx, name=sr.name, initial_average=sr.initial_average,
+                                                   transmuted_average=sr.transmuted_average)
+                                              for idx, sr in enumerate(cs.student_records)])
+
+    @staticmethod
+    def _whole_number(value, what: str) -> int:
+        if isinstance(value, str):
+            value = value.strip()
+            value = int(value) if value.lstrip('-').isdigit() else value
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, '{} must be a whole number, not {!r}'.format(what, value))
+        return value
+
+    def _apply_options(self, session: Session, options) -> dict:
+        if not isinstance(options, dict):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, 'options must be an object')
+        unknown = set(options) - {'threshold', 'max_loop', 'mode', 'seed', 'keep_existing'}
+        if unknown:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, 'Unknown option(s): {}'.format(', '.join(sorted(unknown))))
+
+        threshold = options.get('threshold', RANDOMIZER_THRESHOLD)
+        if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or threshold <= 0:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, 'threshold must be a positive number')
+        mode = options.get('mode', RANDOMIZER_MODE)
+        if mode not in RANDOMIZER_MODES:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, 'mode must be one of {}'.format(', '.join(RANDOMIZER_MODES)))
+        seed = options.get('seed')
+
+        return dict(threshold=threshold,
+                    max_loop=self._whole_number(options.get('max_loop', RANDOMIZER_MAX_LOOP), 'max_loop'),
+                    mode=mode, seed=None if seed is None else self._whole_number(seed, 'seed'),
+                    overwrite_all=not options.get('keep_existing', False),
+                    workers=self.workers, pool=session.pool, executor=self._processes)
+
+    def _apply_sheets(self, session: Session, sheets) -> dict[str, tuple[dict, int]]:
+        # {sheet: (grades, offset)}, a request that fails on its last sheet is refused before the first one changes
+        if not isinstance(sheets, dict):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, 'sheets must map sheet names to their targets')
+
+        checked = {}
+        for name, request in sheets.items():
+            if name not in session.book.sheet_names:
+                raise ServiceError(HTTPStatus.NOT_FOUND, 'No sheet {!r} in {}'.format(name, session.book.path))
+            if not isinstance(request, dict):
+                raise ServiceError(HTTPStatus.BAD_REQUEST, '{}: expected {{"targets": ..., "offset": ...}}'.format(
+                    name))
+            targets = request.get('targets', {})
+            if not isinstance(targets, dict):
+                raise ServiceError(HTTPStatus.BAD_REQUEST, '{}: targets must map learners to grades'.format(name))
+            grades = {str(learner).strip(): self._whole_number(grade, '{}: the grade of {}'.format(name, learner))
+                      for learner, grade in targets.items()}
+            offset = request.get('offset')
+            checked[name] = grades, None if offset is None else self._whole_number(offset, '{}: offset'.format(name))
+
+        return checked
+
+    async def apply(self, session_id: str, sheets: dict, options: dict = None, save=False, output: str = None) -> dict:
+        # sheets maps sheet name to {"targets": {learner name: grade}, "offset": n}. the whole request is checked
+        # first, then every sheet is randomized in a journal transaction and only written back to the book once all
+        # of them went through, an error rolls every sheet back. the book is saved once at the end when save is true
+        session = self.session(session_id)
+        options = self._apply_options(session, options or {})
+        checked = self._apply_sheets(session, sheets)
+
+        stats = RunStats('apply:{}'.format(session.id))
+        results = {}
+        async with session.lock:
+            opened = []
+            try:
+                for name, (grades, offset) in checked.items():
+                    with stats.phase('open'):
+                        cs = await self._run(self._class_sheet, session, name)
+                    cs.journal.begin('apply')
+                    opened.append(cs)
+
+                    applied, failures = await self._run(apply_targets, cs, grades, offset, stats=stats, **options)
+                    learners = {str(sr.name).strip() for sr in cs.student_records}
+                    results[name] = dict(learners=len(cs.student_records), targeted=len(applied),
+                                         changed=sum(any(component.modified for component in sr.components)
+                                                     for sr in cs.student_records),
+                                         failed={cs.student_records[idx].name: error
+                                                 for idx, error in sorted(failures.items())},
+                                         missing=sorted(set(grades) - learners))
+            except BaseException:
+                for cs in opened:
+                    cs.journal.rollback()
+                raise
+
+            for name, cs in zip(checked, opened):
+                cs.journal.commit()
+                report = await self._run(cs.write_sheet)
+                stats.merge(cs.take_stats())
+                results[name].update(cells=report.cells, writes=report.calls)
+
+            if save:
+                with stats.phase('save'):
+                    await self._run(session.book.save, output)
+
+        stats.log()
+        self.stats.merge(stats)
+        return dict(session=session.id, sheets=results, saved=bool(save), stats=stats.as_dict())
+
+    async def save(self, session_id: str, output: str = None) -> dict:
+        session = self.session(session_id)
+        async with session.lock:
+            await self._run(session.book.save, output)
+        return dict(session=session.id, saved=True)
+
+    async def dispatch(self, method: str, path: str, body: dict = None) -> tuple[HTTPStatus, dict]:
+        # the HTTP layer without the sockets, a session added over an in-memory GridWorkbook is driven the same way
+        body = body or {}
+        if not isinstance(body, dict):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, 'The body must be a JSON object')
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        if parts[0] != 'sessions' or len(parts) > 4:
+            raise ServiceError(HTTPStatus.NOT_FOUND, 'No route {}'.format(path))
+
+        if len(parts) == 1:
+            if method == 'GET':
+                return HTTPStatus.OK, dict(sessions=[session.as_dict() for session in self.sessions.values()])
+            if method == 'POST':
+                if not body.get('path'):
+                    raise ServiceError(HTTPStatus.BAD_REQUEST, 'A workbook path is required')
+                session = await self.open(body['path'], body.get('sheets', []))
+                return HTTPStatus.OK, session.as_dict()
+        elif len(parts) == 2:
+            if method == 'GET':
+                return HTTPStatus.OK, self.session(parts[1]).as_dict()
+            if method == 'DELETE':
+                await self.close(parts[1])
+                return HTTPStatus.OK, dict(session=parts[1], closed=True)
+        elif len(parts) == 3 and method == 'POST':
+            if parts[2] == 'apply':
+                return HTTPStatus.OK, await self.apply(parts[1], body.get('sheets', {}), body.get('options'),
+                                                       body.get('save', False), body.get('output'))
+            if parts[2] == 'save':
+                return HTTPStatus.OK, await self.save(parts[1], body.get('output'))
+        elif len(parts) == 4 and parts[2] == 'sheets' and method == 'GET':
+            return HTTPStatus.OK, await self.learners(parts[1], parts[3])
+
+        raise ServiceError(HTTPStatus.METHOD_NOT_ALLOWED, '{} is not allowed on {}'.format(method, path))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # HTTP/1.1 with keep-alive, JSON bodies in and out
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                try:
+                    if length > MAX_BODY_BYTES:
+                        raise ServiceError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'The body is too large')
+                    raw = await reader.readexactly(length) if length else b''
+                    try:
+                        body = json.loads(raw) if raw else None
+                    except ValueError as e:
+                        raise ServiceError(HTTPStatus.BAD_REQUEST, 'Invalid JSON: {}'.format(e))
+                    status, payload = await self.dispatch(method, target.split('?')[0], body)
+                except ServiceError as e:
+                    status, payload = e.status, dict(error=str(e))
+                except (KeyError, ValueError, TypeError) as e:
+                    status, payload = HTTPStatus.BAD_REQUEST, dict(error=str(e))
+                except Exception as e:
+                    status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, dict(error=str(e))
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                data = json.dumps(payload, default=str).encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                             'Connection: {}\r\n\r\n'.format(status.value, status.phrase, len(data),
+                                                             'keep-alive' if keep_alive else 'close').encode('latin-1'))
+                writer.write(data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=SERVICE_HOST, port=SERVICE_PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def shutdown(self):
+        for session in list(self.sessions.values()):
+            session.book.close()
+        self.sessions.clear()
+        self._threads.shutdown()
+        if self._processes is not None:
+            self._processes.shutdown()
+        self.stats.log()
+
+    def __repr__(self):
+        return "<GradingService(sessions='{}', workers='{}')>".format(len(self.sessions), self.workers)
@@ -0,0 +1,104 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# a path in this environment variable logs every finished operation as a JSON line
+STATS_LOG_ENV = 'CLASSGENIE_STATS_LOG'
+
+
+class RunStats:
+    # counters and wall time per phase of one operation: backend calls and cells read and written, randomizer
+    # iterations and the learners brought to their target
+    def __init__(self, operation: str = None):
+        self.operation = operation
+        self.reads = 0
+        self.cells_read = 0
+        self.writes = 0
+        self.cells_written = 0
+        self.saves = 0
+        self.learners = 0
+        self.reached = 0
+        self.iterations = 0
+        self.pool_hits = 0
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def read(self, cells: int):
+        self.reads += 1
+        self.cells_read += cells
+
+    def write(self, cells: int):
+        self.writes += 1
+        self.cells_written += cells
+
+    def randomized(self, iterations: int, reached: bool):
+        self.learners += 1
+        self.iterations += iterations
+        self.reached += reached
+
+    @property
+    def failed(self) -> int:
+        return self.learners - self.reached
+
+    @property
+    def hit_rate(self) -> float:
+        # share of the randomizer's candidates that landed on the target
+        return self.reached / self.iterations if self.iterations else 0.0
+
+    @property
+    def iterations_per_learner(self) -> float:
+        return self.iterations / self.learners if self.learners else 0.0
+
+    @property
+    def elapsed(self) -> float:
+        return sum(self.phases.values())
+
+    def merge(self, other: 'RunStats') -> 'RunStats':
+        for name in ('reads', 'cells_read', 'writes', 'cells_written', 'saves', 'learners', 'reached',
+                     'iterations', 'pool_hits'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for name, seconds in other.phases.items():
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+        return self
+
+    def as_dict(self) -> dict:
+        return dict(operation=self.operation, reads=self.reads, cells_read=self.cells_read, writes=self.writes,
+                    cells_written=self.cells_written, saves=self.saves, learners=self.learners,
+                    reached=self.reached, iterations=self.iterations, pool_hits=self.pool_hits,
+                    hit_rate=round(self.hit_rate, 6),
+                    phases={name: round(seconds, 6) for name, seconds in self.phases.items()})
+
+    def summary(self) -> str:
+        parts = []
+        if self.learners:
+            parts.append('{} of {} learners in {} iterations ({:.1f}/learner, {} from the pool)'.format(
+                self.reached, self.learners, self.iterations, self.iterations_per_learner, self.pool_hits))
+        if self.reads or self.writes:
+            parts.append('{} reads ({} cells), {} writes ({} cells)'.format(self.reads, self.cells_read,
+                                                                           self.writes, self.cells_written))
+        parts.extend('{} {:.2f}s'.format(name, seconds) for name, seconds in self.phases.items())
+
+        return ', '.join(parts)
+
+    def log(self, path: str = None) -> bool:
+        # appends the stats as one JSON line to path, or to $CLASSGENIE_STATS_LOG; returns whether it was logged
+        path = path or os.environ.get(STATS_LOG_ENV)
+        if not path:
+            return False
+
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(dict(self.as_dict(), time=time.time()), separators=(',', ':')) + '\n')
+
+        return True
+
+    def __repr__(self):
+        return "<RunStats(operation='{}', {})>".format(self.operation, self.summary())
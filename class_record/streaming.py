@@ -0,0 +1,67 @@
+from itertools import chain
+from typing import Iterator
+
+from class_record import ClassSheet
+from class_record import StudentRecord
+from class_record import find_label_components
+from class_record import make_student_record
+from class_record.backends import SheetBackend
+from class_record.xlsx import XlsxWorkbook
+
+
+def _cell(row: list, idx: int):
+    return row[idx] if idx < len(row) else None
+
+
+def _pad(row: list, width: int) -> list:
+    return row + [None] * (width - len(row)) if len(row) < width else row
+
+
+def iter_student_records(sheet: SheetBackend) -> Iterator[StudentRecord]:
+    # single pass over the rows of a sheet, only the current row is kept in memory
+    rows = enumerate(sheet.iter_rows(), start=1)
+
+    for _, row in rows:
+        if str(_cell(row, 0)).endswith('QUARTER'):
+            break
+    else:
+        return
+
+    label_row, label = next(rows, (None, None))
+    if label is None:
+        return
+    merges = sheet.merge_areas(label_row, [col for col, value in enumerate(label, start=1) if value is not None])
+    label_components = find_label_components(label, merges)
+    if not label_components:
+        return
+    width = max(columns.end for columns in label_components)
+
+    next(rows, None)
+    _, head = next(rows, (None, None))
+    if head is None:
+        return
+    head = _pad(head, width)
+    head_components = [ClassSheet.generate_component(head[columns.start:columns.end], columns.label)
+                       for columns in label_components]
+
+    for marker in ('MALE', 'FEMALE'):
+        for _, row in rows:
+            if str(_cell(row, 1)).startswith(marker):
+                break
+        else:
+            return
+
+        first = True
+        for row_num, row in rows:
+            if not first and _cell(row, 0) is None:
+                # the row ending a block is searched again for the next marker, like ClassSheet.student_rows does
+                rows = chain([(row_num, row)], rows)
+                break
+            first = False
+            yield make_student_record(_pad(row, width), label_components, head_components)
+
+
+def iter_class_records(book: XlsxWorkbook, sheet_names: list[str] = None) -> Iterator[tuple[str, StudentRecord]]:
+    for name in sheet_names if sheet_names is not None else book.sheet_names:
+        for record in iter_student_records(book.sheet(name)):
+            yield name, record
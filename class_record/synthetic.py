@@ -0,0 +1,148 @@
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+from class_record import ClassSheet
+from class_record.backends import GridBackend
+from class_record.xlsx import column_letters
+
+COMPONENT_LABELS = ('WRITTEN WORKS', 'PERFORMANCE TASKS', 'QUARTERLY ASSESSMENT')
+COMPONENT_ITEMS = (10, 10, 1)
+COMPONENT_WEIGHTS = (0.3, 0.5, 0.2)
+HIGHEST_SCORES = (10, 15, 20, 25, 30, 50)
+
+
+def class_grid(males=20, females=20, items=COMPONENT_ITEMS, weights=COMPONENT_WEIGHTS, labels=COMPONENT_LABELS,
+               quarter='FIRST QUARTER', blanks=0.0, seed=None) -> tuple[list[list], list[tuple]]:
+    # a class record laid out like the DepEd template: title, QUARTER row, merged component labels over the item,
+    # Total, PS and WS columns, item numbers, the HIGHEST POSSIBLE SCORE row, then the MALE and FEMALE blocks.
+    # blanks is the share of learner scores left empty
+    # returns (grid, merges) for GridBackend, merges are (first_row, first_col, last_row, last_col)
+    rng = random.Random(seed)
+    width = 2 + sum(n + 3 for n in items) + 2
+
+    def row():
+        return [None] * width
+
+    grid = []
+    title = row()
+    title[0] = 'CLASS RECORD'
+    grid.append(title)
+    quarter_row = row()
+    quarter_row[0] = quarter
+    grid.append(quarter_row)
+    label = row()
+    label[1] = "LEARNERS' NAMES"
+    numbers = row()
+    head = row()
+    head[1] = 'HIGHEST POSSIBLE SCORE'
+    grid.extend([label, numbers, head])
+    merges = [(1, 1, 1, width), (3, 2, 4, 2)]
+
+    plan = []
+    col = 2
+    for component_label, n, weight in zip(labels, items, weights):
+        label[col] = component_label
+        merges.append((3, col + 1, 3, col + n + 3))
+        highest = [float(rng.choice(HIGHEST_SCORES)) for _ in range(n)]
+        numbers[col:col + n + 3] = list(range(1, n + 1)) + ['Total', 'PS', 'WS']
+        head[col:col + n + 3] = highest + [sum(highest), 100.0, weight]
+        plan.append((col, highest, weight))
+        col += n + 3
+    label[col] = 'INITIAL GRADE'
+    label[col + 1] = 'QUARTERLY GRADE'
+
+    def learners(count, prefix):
+        rows = []
+        for idx in range(count):
+            learner = row()
+            learner[0] = idx + 1
+            learner[1] = '{} {:04d}, LEARNER'.format(prefix, idx + 1)
+            # one ability per learner so the components agree the way real grades do
+            ability = rng.uniform(0.55, 1.0)
+            for start, highest, weight in plan:
+                scores = [None if rng.random() < blanks else
+                          float(min(h, max(0, round(h * rng.gauss(ability, 0.1))))) for h in highest]
+                total = sum(score for score in scores if score is not None)
+                percentage = round(total / sum(highest) * 100, 2)
+                learner[start:start + len(scores) + 3] = scores + [total, percentage, round(percentage * weight, 2)]
+            rows.append(learner)
+
+        return rows
+
+    for marker, count in (('MALE', males), ('FEMALE', females)):
+        block = row()
+        block[1] = marker
+        grid.append(block)
+        grid.extend(learners(count, marker))
+        grid.append(row())
+
+    return grid, merges
+
+
+def class_sheet(males=20, females=20, **options) -> ClassSheet:
+    grid, merges = class_grid(males, females, **options)
+    return ClassSheet(GridBackend(grid, merges))
+
+
+def _sheet_xml(grid: list[list], merges: list[tuple]) -> str:
+    rows = []
+    for row_num, row in enumerate(grid, start=1):
+        cells = []
+        for col, value in enumerate(row, start=1):
+            if value is None:
+                continue
+            ref = column_letters(col) + str(row_num)
+            if isinstance(value, str):
+                cells.append('<c r="{}" t="inlineStr"><is><t>{}</t></is></c>'.format(ref, escape(value)))
+            else:
+                cells.append('<c r="{}"><v>{!r}</v></c>'.format(ref, value))
+        if cells:
+            rows.append('<row r="{}">{}</row>'.format(row_num, ''.join(cells)))
+
+    merge_cells = ''.join('<mergeCell ref="{}{}:{}{}"/>'.format(column_letters(first_col), first_row,
+                                                                 column_letters(last_col), last_row)
+                          for first_row, first_col, last_row, last_col in merges)
+
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<sheetData>{}</sheetData><mergeCells count="{}">{}</mergeCells></worksheet>').format(
+        ''.join(rows), len(merges), merge_cells)
+
+
+def write_workbook(path: str, sheets: dict[str, tuple[list[list], list[tuple]]]):
+    # a minimal .xlsx with one worksheet per (grid, merges) of sheets, readable by XlsxWorkbook and Excel
+    content_types = ''.join(
+        '<Override PartName="/xl/worksheets/sheet{}.xml" ContentType="application/vnd.openxmlformats-'
+        'officedocument.spreadsheetml.worksheet+xml"/>'.format(idx) for idx in range(1, len(sheets) + 1))
+    workbook_sheets = ''.join('<sheet name="{}" sheetId="{}" r:id="rId{}"/>'.format(escape(name, {'"': '&quot;'}),
+                                                                                    idx, idx)
+                              for idx, name in enumerate(sheets, start=1))
+    relationships = ''.join(
+        '<Relationship Id="rId{0}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+        'worksheet" Target="worksheets/sheet{0}.xml"/>'.format(idx) for idx in range(1, len(sheets) + 1))
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml',
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                    '<Default Extension="xml" ContentType="application/xml"/>'
+                    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-'
+                    'officedocument.spreadsheetml.sheet.main+xml"/>{}</Types>'.format(content_types))
+        zf.writestr('_rels/.rels',
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+                    'relationships/officeDocument" Target="xl/workbook.xml"/></Relationships>')
+        zf.writestr('xl/workbook.xml',
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                    '<sheets>{}</sheets></workbook>'.format(workbook_sheets))
+        zf.writestr('xl/_rels/workbook.xml.rels',
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                    '{}</Relationships>'.format(relationships))
+        for idx, (grid, merges) in enumerate(sheets.values(), start=1):
+            zf.writestr('xl/worksheets/sheet{}.xml'.format(idx), _sheet_xml(grid, merges))
@@ -0,0 +1,117 @@
+import bisect
+from collections import namedtuple
+
+RangeTuple = namedtuple('RangeTuple', ['min', 'max', 'transmuted'])
+
+
+class TransmutationTable:
+    def __init__(self, rows: list[RangeTuple] = None, path: str = None):
+        # given only a path, the file is read and checked on the first lookup
+        self._path = path
+        self._rows = None
+        if rows is not None:
+            self._compile(rows)
+
+    def _load(self):
+        with open(self._path, 'r') as f:
+            self._compile(self._parse(f.read()))
+
+    def _compile(self, rows: list[RangeTuple]):
+        rows = sorted(rows, key=lambda row: row.min)
+        for prev, row in zip(rows, rows[1:]):
+            if row.min <= prev.max:
+                raise ValueError('Overlapping ranges {} and {}.'.format(prev, row))
+
+        # inverse index, transmuted grade -> initial average interval producing it
+        intervals = {}
+        for row in rows:
+            found = intervals.get(row.transmuted)
+            if found is not None:
+                row = RangeTuple(min=min(found.min, row.min), max=max(found.max, row.max), transmuted=row.transmuted)
+            intervals[row.transmuted] = row
+
+        # sorted boundaries, a lookup is a binary search on the lower bounds
+        self._mins = [row.min for row in rows]
+        self._maxs = [row.max for row in rows]
+        self._transmuted = [row.transmuted for row in rows]
+        self._arrays = None
+        self._intervals = intervals
+        # set last, a lookup on another thread loads the table until _rows is set and finds everything else ready
+        self._rows = rows
+
+    @staticmethod
+    def _parse(text: str) -> list[RangeTuple]:
+        rows = []
+        for line in text.strip().splitlines():
+            line = line.strip().split(',')
+            _range = tuple(map(float, line[0].split('-')))
+            rows.append(RangeTuple(min=_range[0], max=_range[1], transmuted=int(line[1].strip())))
+
+        return rows
+
+    @classmethod
+    def from_text(cls, text: str) -> 'TransmutationTable':
+        return cls(cls._parse(text))
+
+    @classmethod
+    def from_file(cls, path: str, lazy=False) -> 'TransmutationTable':
+        if lazy:
+            return cls(path=path)
+
+        with open(path, 'r') as f:
+            return cls.from_text(f.read())
+
+    def transmute(self, initial_grade):
+        if self._rows is None:
+            self._load()
+        idx = bisect.bisect_right(self._mins, initial_grade) - 1
+        if idx >= 0 and initial_grade <= self._maxs[idx]:
+            return self._transmuted[idx]
+
+        return None
+
+    def transmute_many(self, initial_grades, default=0):
+        import numpy as np
+
+        if self._rows is None:
+            self._load()
+        arrays = self._arrays
+        if arrays is None:
+            arrays = self._arrays = (np.array(self._mins), np.array(self._maxs), np.array(self._transmuted))
+        mins, maxs, transmuted = arrays
+
+        initial_grades = np.asarray(initial_grades, dtype=float)
+        idx = np.searchsorted(mins, initial_grades, side='right') - 1
+        clipped = np.clip(idx, 0, len(mins) - 1)
+        found = (idx >= 0) & (initial_grades <= maxs[clipped])
+
+        return np.where(found, transmuted[clipped], default)
+
+    def interval(self, transmuted) -> RangeTuple:
+        if self._rows is None:
+            self._load()
+        return self._intervals.get(transmuted)
+
+    @property
+    def grades(self) -> list[int]:
+        if self._rows is None:
+            self._load()
+        return sorted(self._intervals)
+
+    def __iter__(self):
+        if self._rows is None:
+            self._load()
+        return iter(self._rows)
+
+    def __len__(self):
+        if self._rows is None:
+            self._load()
+        return len(self._rows)
+
+    def __getitem__(self, idx):
+        if self._rows is None:
+            self._load()
+        return self._rows[idx]
+
+    def __repr__(self):
+        return "<TransmutationTable(rows='{}', grades='{}-{}')>".format(len(self), min(self.grades), max(self.grades))
@@ -0,0 +1,81 @@
+import os
+from functools import partial
+from typing import Union
+
+from class_record import ClassSheet
+from class_record.backends import GridWorkbook
+from class_record.backends import XlwingsWorkbook
+from class_record.cache import ParseCache
+from class_record.xlsx import XlsxWorkbook
+
+
+class ClassWorkbook:
+    # the sheet names come from the .xlsx metadata alone, the book itself is only opened (in Excel when excel is
+    # true) once a sheet is asked for, and each ClassSheet is parsed on first use and kept until the book is closed.
+    # with a cache, sheets parsed in an earlier session are loaded from it while the workbook is unchanged, others
+    # are still parsed on first use and stored once they are.
+    # an already opened book (e.g. a GridWorkbook) is used as it is, path then only names it
+    def __init__(self, path: str, excel=False, cache: ParseCache = None,
+                 book: Union[XlsxWorkbook, XlwingsWorkbook, GridWorkbook] = None):
+        self.path = path
+        self.excel = excel
+        self.cache = cache
+        self._metadata = XlsxWorkbook(path) if book is None else book
+        self._book = book
+        self._class_sheets = {}
+
+    @property
+    def sheet_names(self) -> list[str]:
+        return self._metadata.sheet_names
+
+    @property
+    def book(self) -> Union[XlsxWorkbook, XlwingsWorkbook, GridWorkbook]:
+        if self._book is None:
+            self._book = XlwingsWorkbook(self.path) if self.excel else self._metadata
+
+        return self._book
+
+    @property
+    def is_open(self) -> bool:
+        return self._book is not None
+
+    def class_sheet(self, name: str) -> ClassSheet:
+        class_sheet = self._class_sheets.get(name)
+        if class_sheet is None:
+            if name not in self.sheet_names:
+                raise KeyError(name)
+            sheet = self.book.sheet(name)
+            if self.cache is not None:
+                class_sheet = self.cache.load(self.path, name, sheet, on_save=self._saved)
+                if class_sheet is None:
+                    class_sheet = ClassSheet(sheet, on_save=self._saved, on_parse=partial(self._parsed, name))
+            else:
+                class_sheet = ClassSheet(sheet)
+            self._class_sheets[name] = class_sheet
+
+        return class_sheet
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._class_sheets
+
+    def _parsed(self, name: str, class_sheet: ClassSheet):
+        self.cache.store(self.path, name, class_sheet)
+
+    def _saved(self, class_sheet: ClassSheet):
+        self.cache.invalidate(self.path)
+
+    def save(self, path: str = None):
+        if self._book is not None:
+            self._book.save(path)
+            if self.cache is not None and (path is None or os.path.samefile(path, self.path)):
+                self.cache.invalidate(self.path)
+
+    def close(self):
+        if self._book is not None:
+            self._book.close()
+        self._book = None
+        self._class_sheets.clear()
+
+    def __repr__(self):
+        return "<ClassWorkbook(path='{}', sheets='{}', loaded='{}')>".format(self.path, len(self.sheet_names),
+                                                                            list(self._class_sheets))
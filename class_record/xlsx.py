@@ -0,0 +1,363 @@
+import os
+import posixpath
+import re
+import tempfile
+import zipfile
+from typing import Iterator
+from xml.etree import ElementTree
+
+from class_record.backends import SheetBackend
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+CALC_CHAIN_PART = 'xl/calcChain.xml'
+
+_CELL_REF = re.compile(r'([A-Z]+)(\d+)')
+
+
+def _tag(name):
+    return '{%s}%s' % (MAIN_NS, name)
+
+
+def column_index(letters: str) -> int:
+    index = 0
+    for char in letters:
+        index = index * 26 + ord(char) - ord('A') + 1
+
+    return index
+
+
+def column_letters(index: int) -> str:
+    letters = ''
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+
+    return letters
+
+
+def split_ref(ref: str) -> tuple[int, int]:
+    letters, row = _CELL_REF.match(ref).groups()
+    return int(row), column_index(letters)
+
+
+def _text(elem) -> str:
+    # plain or rich text runs of a shared or inline string, phonetic runs are skipped
+    t = elem.find(_tag('t'))
+    if t is not None:
+        return t.text or ''
+
+    return ''.join(t.text or '' for t in elem.findall('{0}/{1}'.format(_tag('r'), _tag('t'))))
+
+
+def _cell_value(cell, shared_strings: list[str]):
+    kind = cell.get('t', 'n')
+    if kind == 'inlineStr':
+        inline = cell.find(_tag('is'))
+        return _text(inline) if inline is not None else None
+
+    v = cell.find(_tag('v'))
+    if v is None or v.text is None:
+        return None
+    if kind == 's':
+        return shared_strings[int(v.text)]
+    if kind == 'b':
+        return v.text == '1'
+    if kind in ('str', 'e'):
+        return v.text
+
+    return float(v.text)
+
+
+def _escape(text: str) -> str:
+    # same as xml.sax.saxutils.escape, which would import urllib and http.client with it
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _cell_xml(prefix: str, ref: str, style: str, value) -> str:
+    attrs = ' r="{}"'.format(ref)
+    if style is not None:
+        attrs += ' s="{}"'.format(style)
+
+    if value is None:
+        return '<{}c{}/>'.format(prefix, attrs)
+    if isinstance(value, bool):
+        return '<{0}c{1} t="b"><{0}v>{2}</{0}v></{0}c>'.format(prefix, attrs, int(value))
+    if isinstance(value, (int, float)):
+        return '<{0}c{1}><{0}v>{2}</{0}v></{0}c>'.format(prefix, attrs, repr(value))
+
+    return '<{0}c{1} t="inlineStr"><{0}is><{0}t>{2}</{0}t></{0}is></{0}c>'.format(prefix, attrs, _escape(str(value)))
+
+
+def patch_sheet_xml(xml: str, cells: dict[tuple[int, int], object]) -> str:
+    # rewrites only the touched <c> elements, everything else in the part is kept byte for byte
+    prefix = re.search(r'<(\w+:)?worksheet\b', xml).group(1) or ''
+    row_pattern = re.compile(r'<{0}row\b[^>]*?\br="(\d+)"[^>]*?(?:/>|>.*?</{0}row>)'.format(prefix), re.S)
+    cell_pattern = re.compile(r'<{0}c\b[^>]*?\br="([A-Z]+\d+)"[^>]*?(?:/>|>.*?</{0}c>)'.format(prefix), re.S)
+    style_pattern = re.compile(r'^<{}c\b[^>]*?\bs="(\d+)"'.format(prefix))
+
+    by_row = {}
+    for (row, col), value in cells.items():
+        by_row.setdefault(row, {})[col] = value
+
+    def patch_row(row_xml, row, values):
+        head = re.match(r'<{}row\b[^>]*?(?=/?>)'.format(prefix), row_xml).group(0)
+        closing = '</{}row>'.format(prefix)
+        body = row_xml[len(head):row_xml.rindex(closing)].lstrip('>') if closing in row_xml else ''
+
+        existing = {split_ref(m.group(1))[1]: m for m in cell_pattern.finditer(body)}
+        pieces = []
+        pos = 0
+        for col in sorted(set(existing) | set(values)):
+            match = existing.get(col)
+            if match is not None:
+                pieces.append(body[pos:match.start()])
+                pos = match.end()
+                if col not in values:
+                    pieces.append(match.group(0))
+                    continue
+                style = style_pattern.match(match.group(0))
+                style = style.group(1) if style else None
+            else:
+                style = None
+            pieces.append(_cell_xml(prefix, column_letters(col) + str(row), style, values[col]))
+        pieces.append(body[pos:])
+
+        return '{}>{}</{}row>'.format(re.sub(r'\sspans="[^"]*"', '', head), ''.join(pieces), prefix)
+
+    chunks = []
+    pos = 0
+    pending = by_row
+    sheet_data = re.search(r'<{0}sheetData\s*/>|<{0}sheetData\b[^>]*>'.format(prefix), xml)
+    if sheet_data.group(0).endswith('/>'):
+        xml = '{}<{}sheetData></{}sheetData>{}'.format(xml[:sheet_data.start()], prefix, prefix,
+                                                      xml[sheet_data.end():])
+        sheet_data = re.search(r'<{}sheetData\b[^>]*>'.format(prefix), xml)
+    data_end = xml.index('</{}sheetData>'.format(prefix))
+
+    for match in row_pattern.finditer(xml, sheet_data.end(), data_end):
+        row = int(match.group(1))
+        chunks.append(xml[pos:match.start()])
+        for missing in sorted(r for r in list(pending) if r < row):
+            chunks.append(patch_row('<{}row r="{}">'.format(prefix, missing), missing, pending.pop(missing)))
+        if row in pending:
+            chunks.append(patch_row(match.group(0), row, pending.pop(row)))
+        else:
+            chunks.append(match.group(0))
+        pos = match.end()
+
+    chunks.append(xml[pos:data_end])
+    for missing in sorted(pending):
+        chunks.append(patch_row('<{}row r="{}">'.format(prefix, missing), missing, pending[missing]))
+    chunks.append(xml[data_end:])
+
+    return ''.join(chunks)
+
+
+class XlsxWorkbook:
+    def __init__(self, path: str):
+        self.path = path
+        self._sheet_parts = None
+        self._shared_strings = None
+        self._pending = {}
+
+    @property
+    def sheet_parts(self) -> dict[str, str]:
+        # sheet name -> zip member, in workbook order
+        if self._sheet_parts is None:
+            with zipfile.ZipFile(self.path) as zf:
+                workbook = ElementTree.fromstring(zf.read('xl/workbook.xml'))
+                rels = ElementTree.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+
+            targets = {rel.get('Id'): rel.get('Target') for rel in rels.iter('{%s}Relationship' % PACKAGE_REL_NS)}
+            parts = {}
+            for sheet in workbook.iter(_tag('sheet')):
+                target = targets[sheet.get('{%s}id' % REL_NS)]
+                if target.startswith('/'):
+                    part = target.lstrip('/')
+                else:
+                    part = posixpath.normpath(posixpath.join('xl', target))
+                parts[sheet.get('name')] = part
+
+            self._sheet_parts = parts
+
+        return self._sheet_parts
+
+    @property
+    def sheet_names(self) -> list[str]:
+        return list(self.sheet_parts)
+
+    @property
+    def shared_strings(self) -> list[str]:
+        if self._shared_strings is None:
+            with zipfile.ZipFile(self.path) as zf:
+                if 'xl/sharedStrings.xml' in zf.namelist():
+                    root = ElementTree.fromstring(zf.read('xl/sharedStrings.xml'))
+                    self._shared_strings = [_text(si) for si in root.iter(_tag('si'))]
+                else:
+                    self._shared_strings = []
+
+        return self._shared_strings
+
+    def sheet(self, name: str) -> 'XlsxSheet':
+        return XlsxSheet(self, name)
+
+    def set_cells(self, name: str, cells: dict[tuple[int, int], object]):
+        self._pending.setdefault(self.sheet_parts[name], {}).update(cells)
+
+    def save(self, path: str = None):
+        path = path if path is not None else self.path
+        if not self._pending and path == self.path:
+            return
+
+        fd, tmp = tempfile.mkstemp(suffix='.xlsx', dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        try:
+            with zipfile.ZipFile(self.path) as src, zipfile.ZipFile(tmp, 'w') as dst:
+                for info in src.infolist():
+                    if info.filename == CALC_CHAIN_PART and self._pending:
+                        continue
+                    data = src.read(info.filename)
+                    if info.filename in self._pending:
+                        xml = patch_sheet_xml(data.decode('utf-8'), self._pending[info.filename])
+                        data = xml.encode('utf-8')
+                    elif self._pending and info.filename == 'xl/workbook.xml':
+                        data = _full_calc_on_load(data.decode('utf-8')).encode('utf-8')
+                    elif self._pending and info.filename == 'xl/_rels/workbook.xml.rels':
+                        data = re.sub(r'<Relationship\b[^>]*?Target="[^"]*calcChain\.xml"[^>]*/>', '',
+                                      data.decode('utf-8')).encode('utf-8')
+                    elif self._pending and info.filename == '[Content_Types].xml':
+                        data = re.sub(r'<Override\b[^>]*?PartName="/xl/calcChain\.xml"[^>]*/>', '',
+                                      data.decode('utf-8')).encode('utf-8')
+                    dst.writestr(info, data)
+            # the source is closed first, Windows refuses to replace a file that is still open
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        self.path = path
+        self._pending = {}
+
+    def close(self):
+        self._pending = {}
+
+
+def _full_calc_on_load(xml: str) -> str:
+    # cached results of formulas depending on the written cells are stale, let Excel recalculate them
+    prefix = re.search(r'<(\w+:)?workbook\b', xml).group(1) or ''
+    calc_pr = re.search(r'<{}calcPr\b[^>]*?/?>'.format(prefix), xml)
+    if calc_pr is None:
+        end = xml.rindex('</{}workbook>'.format(prefix))
+        return '{}<{}calcPr fullCalcOnLoad="1"/>{}'.format(xml[:end], prefix, xml[end:])
+    if 'fullCalcOnLoad=' in calc_pr.group(0):
+        return xml
+
+    tag = calc_pr.group(0)
+    closing = '/>' if tag.endswith('/>') else '>'
+    patched = tag[:-len(closing)].rstrip() + ' fullCalcOnLoad="1"' + closing
+    return xml[:calc_pr.start()] + patched + xml[calc_pr.end():]
+
+
+class XlsxSheet(SheetBackend):
+    def __init__(self, book: XlsxWorkbook, name: str):
+        self._book = book
+        self._name = name
+        self._merges = None
+
+    @property
+    def book(self) -> XlsxWorkbook:
+        return self._book
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def part(self) -> str:
+        return self._book.sheet_parts[self._name]
+
+    def _iter_elements(self) -> Iterator[ElementTree.Element]:
+        # <row> elements are dropped from the tree once handled so a pass over the part keeps constant memory
+        sheet_data = None
+        with zipfile.ZipFile(self._book.path) as zf, zf.open(self.part) as f:
+            for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if elem.tag == _tag('sheetData'):
+                        sheet_data = elem
+                elif elem.tag == _tag('row'):
+                    yield elem
+                    sheet_data.clear()
+                elif elem.tag == _tag('mergeCell'):
+                    yield elem
+
+    @staticmethod
+    def _row_values(elem, shared_strings: list[str]) -> list:
+        values = []
+        col = 0
+        for cell in elem.iter(_tag('c')):
+            col = split_ref(cell.get('r'))[1] if cell.get('r') else col + 1
+            value = _cell_value(cell, shared_strings)
+            if value is not None:
+                values.extend([None] * (col - len(values)))
+                values[col - 1] = value
+
+        return values
+
+    @staticmethod
+    def _merge_ref(elem) -> tuple[int, int, int, int]:
+        first, _, last = elem.get('ref').partition(':')
+        return split_ref(first) + split_ref(last or first)
+
+    def read_grid(self) -> list[list]:
+        rows = []
+        merges = []
+        for row in self.iter_rows(merges):
+            rows.append(row)
+
+        self._merges = merges
+        while rows and not rows[-1]:
+            rows.pop()
+        width = max((len(row) for row in rows), default=0)
+
+        return [row + [None] * (width - len(row)) for row in rows]
+
+    def iter_rows(self, merges: list = None) -> Iterator[list]:
+        # rows missing from the part are yielded as empty lists, merged cells are collected into merges if given
+        shared_strings = self._book.shared_strings
+        last = 0
+        for elem in self._iter_elements():
+            if elem.tag == _tag('mergeCell'):
+                if merges is not None:
+                    merges.append(self._merge_ref(elem))
+                continue
+
+            row = int(elem.get('r', last + 1))
+            for _ in range(last + 1, row):
+                yield []
+            yield self._row_values(elem, shared_strings)
+            last = row
+
+    @property
+    def merges(self) -> list[tuple[int, int, int, int]]:
+        if self._merges is None:
+            self._merges = [self._merge_ref(elem) for elem in self._iter_elements() if elem.tag == _tag('mergeCell')]
+
+        return self._merges
+
+    def merge_areas(self, row: int, columns: list[int]) -> dict[int, int]:
+        return {first_col: last_col for first_row, first_col, last_row, last_col in self.merges
+                if first_row == row and first_col in columns}
+
+    def write_block(self, row: int, column: int, values: list[list]):
+        cells = {}
+        for row_idx, data in enumerate(values, start=row):
+            for col_idx, value in enumerate(data, start=column):
+                cells[(row_idx, col_idx)] = value
+
+        self._book.set_cells(self._name, cells)
+
+    def save(self):
+        self._book.save()
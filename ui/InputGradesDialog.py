@@ -20,10 +20,10 @@ class Ui_InputGradesDialog(object):
         InputGradesDialog.resize(577, 396)
         self.gridLayout = QGridLayout(InputGradesDialog)
         self.gridLayout.setObjectName(u"gridLayout")
-        self.tableWidget = QTableWidget(InputGradesDialog)
-        self.tableWidget.setObjectName(u"tableWidget")
+        self.tableView = QTableView(InputGradesDialog)
+        self.tableView.setObjectName(u"tableView")
 
-        self.gridLayout.addWidget(self.tableWidget, 0, 0, 5, 1)
+        self.gridLayout.addWidget(self.tableView, 0, 0, 5, 1)
 
         self.pushButton = QPushButton(InputGradesDialog)
         self.pushButton.setObjectName(u"pushButton")